@@ -0,0 +1,77 @@
+import sys, os
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse, json
+
+# Environment fields that make numbers incomparable when they differ
+ENV_KEYS = ("cpu", "cpu_usable", "torch", "transformers", "model", "standin_spec", "settings")
+
+
+def compare(baseline, current, tolerance):
+    """Rows of (metric, baseline, current, relative change, status) for every metric in either run.
+
+    Status is "regression" / "improvement" when the change in the metric's
+    bad / good direction exceeds tolerance, else "ok"; "new" / "missing" when
+    only one run has it.
+    """
+    rows = []
+    base_metrics, cur_metrics = baseline["metrics"], current["metrics"]
+    for name in sorted(set(base_metrics) | set(cur_metrics)):
+        b, c = base_metrics.get(name), cur_metrics.get(name)
+        if b is None or c is None:
+            rows.append((name, b and b["value"], c and c["value"], None, "new" if b is None else "missing"))
+            continue
+        if b["value"] == 0:
+            change = 0.0 if c["value"] == 0 else float("inf")
+        else:
+            change = (c["value"] - b["value"]) / abs(b["value"])
+        worse = -change if c["better"] == "higher" else change
+        status = "regression" if worse > tolerance else "improvement" if worse < -tolerance else "ok"
+        rows.append((name, b["value"], c["value"], change, status))
+    return rows
+
+
+def main():
+    p = argparse.ArgumentParser(description="Flag performance regressions against a stored benchmark baseline")
+    p.add_argument("--current", default="artifacts/bench/results.json")
+    p.add_argument("--baseline", default="bench/baseline.json")
+    p.add_argument("--tolerance", type=float, default=0.10, help="relative change tolerated before flagging")
+    p.add_argument("--warn_only", action="store_true", help="exit 0 even when something regressed")
+    args = p.parse_args()
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; record one with `make bench-baseline`")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+
+    differs = [k for k in ENV_KEYS if baseline["env"].get(k) != current["env"].get(k)]
+    if differs:
+        print("⚠️  Environment differs from the baseline, numbers may not be comparable:")
+        for k in differs:
+            print(f"   {k}: {baseline['env'].get(k)!r} -> {current['env'].get(k)!r}")
+        print()
+
+    rows = compare(baseline, current, args.tolerance)
+    width = max(len(r[0]) for r in rows) if rows else 10
+    print(f"{'metric':<{width}} {'baseline':>12} {'current':>12} {'change':>8}  status")
+    print("-" * (width + 44))
+    for name, b, c, change, status in rows:
+        b_s = f"{b:>12.4g}" if b is not None else f"{'-':>12}"
+        c_s = f"{c:>12.4g}" if c is not None else f"{'-':>12}"
+        ch_s = f"{change:>+8.1%}" if change is not None else f"{'-':>8}"
+        flag = {"regression": "❌ regression", "improvement": "✅ improvement"}.get(status, status)
+        print(f"{name:<{width}} {b_s} {c_s} {ch_s}  {flag}")
+
+    regressions = [r for r in rows if r[4] == "regression"]
+    print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%} "
+          f"(baseline {(baseline['env'].get('git_commit') or '?')[:10]}, "
+          f"current {(current['env'].get('git_commit') or '?')[:10]})")
+    return 1 if regressions and not args.warn_only else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import sys, os
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse, json, time, resource, subprocess, statistics as st
+
+BASE = os.getenv("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+ADAPTER = os.getenv("OUT_DIR", "artifacts/sft")
+MERGED = os.getenv("MERGED_DIR", "artifacts/merged")
+
+
+def measure(mode, max_tokens):
+    """Load the served model in one mode and time it over the eval suites (greedy)"""
+    from serve.loading import load_model, load_tokenizer, model_memory_bytes, process_rss_bytes, quantize_model
+    from serve.batching import GenerationJob, generate_batch
+    from eval.run_eval import SUITES, load_suite
+    from eval.metrics import score_example
+
+    t0 = time.perf_counter()
+    tok = load_tokenizer(BASE)
+    model, weights = load_model(BASE, ADAPTER, MERGED)
+    model = quantize_model(model, mode)
+    load_s = time.perf_counter() - t0
+
+    latencies, generated, scores = [], 0, {}
+    for name, path in SUITES.items():
+        suite = []
+        for ex in load_suite(path):
+            job = GenerationJob(prompt=ex["prompt"], max_tokens=max_tokens, temperature=0)
+            t = time.perf_counter()
+            result = generate_batch(model, tok, [job])[0]
+            latencies.append(time.perf_counter() - t)
+            generated += result["generated_tokens"]
+            suite.append(score_example(ex, result["text"])["avg"])
+        scores[name] = round(st.mean(suite), 4)
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "weights": weights,
+        "load_s": round(load_s, 2),
+        "weights_mb": round(model_memory_bytes(model) / 2**20, 1),
+        "rss_mb": round(process_rss_bytes() / 2**20, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "latency_s_mean": round(st.mean(latencies), 3),
+        "latency_s_p95": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 3),
+        "tokens_per_s": round(generated / sum(latencies), 2),
+        "scores": scores,
+        "score_avg": round(st.mean(scores.values()), 4),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description="Compare fp32 and int8 serving: latency, RSS and eval scores")
+    p.add_argument("--modes", nargs="+", default=["fp32", "int8"])
+    p.add_argument("--max_tokens", type=int, default=64)
+    p.add_argument("--out", default="artifacts/bench/quantization.json")
+    p.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.max_tokens)))
+        return
+
+    # One process per mode so RSS numbers don't bleed into each other
+    results = []
+    for mode in args.modes:
+        print(f"Benchmarking {mode}...")
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", mode, "--max_tokens", str(args.max_tokens)],
+            capture_output=True, text=True, check=True,
+        )
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print("\n" + "="*60)
+    print("QUANTIZATION BENCHMARK")
+    print("="*60)
+    print(f"{'mode':<6} {'load s':>7} {'weights MB':>11} {'RSS MB':>8} {'lat s':>7} {'p95 s':>7} {'tok/s':>7} {'score':>6}")
+    for r in results:
+        print(f"{r['mode']:<6} {r['load_s']:>7} {r['weights_mb']:>11} {r['rss_mb']:>8} "
+              f"{r['latency_s_mean']:>7} {r['latency_s_p95']:>7} {r['tokens_per_s']:>7} {r['score_avg']:>6.2%}")
+    print("="*60)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
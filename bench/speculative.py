@@ -0,0 +1,137 @@
+import sys, os
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse, json, time, statistics as st
+from contextlib import contextmanager
+
+BASE = os.getenv("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+ADAPTER = os.getenv("OUT_DIR", "artifacts/sft")
+MERGED = os.getenv("MERGED_DIR", "artifacts/merged")
+
+
+@contextmanager
+def count_speculation(model, counts):
+    """Count served-model forward passes plus proposed and accepted draft tokens while active"""
+    from transformers.generation import candidate_generator as cg
+
+    def forward_hook(module, args, output):
+        counts["forwards"] += 1
+
+    patched = []
+    for cls in (cg.PromptLookupCandidateGenerator, cg.AssistedCandidateGenerator):
+        get, update = cls.get_candidates, cls.update_candidate_strategy
+
+        def get_candidates(self, input_ids, _get=get):
+            candidates, logits = _get(self, input_ids)
+            counts["proposed"] += candidates.shape[1] - input_ids.shape[1]
+            return candidates, logits
+
+        def update_candidate_strategy(self, input_ids, scores, num_matches, _update=update):
+            counts["accepted"] += int(num_matches)
+            return _update(self, input_ids, scores, num_matches)
+
+        patched.append((cls, get, update))
+        cls.get_candidates, cls.update_candidate_strategy = get_candidates, update_candidate_strategy
+
+    # lm_head runs once per forward of the served model, merged or with adapters
+    hook = model.get_output_embeddings().register_forward_hook(forward_hook)
+    try:
+        yield counts
+    finally:
+        hook.remove()
+        for cls, get, update in patched:
+            cls.get_candidates, cls.update_candidate_strategy = get, update
+
+
+def measure(model, tok, mode, speculative, max_tokens, temperature):
+    """Generate every eval-suite prompt one at a time under one speculative setting"""
+    from serve.batching import GenerationJob, generate_batch
+    from eval.run_eval import SUITES, load_suite
+    from eval.metrics import score_example
+
+    counts = {"forwards": 0, "proposed": 0, "accepted": 0}
+    latencies, generated, texts, scores = [], 0, [], {}
+    with count_speculation(model, counts):
+        for name, path in SUITES.items():
+            suite = []
+            for ex in load_suite(path):
+                job = GenerationJob(prompt=ex["prompt"], max_tokens=max_tokens, temperature=temperature)
+                t = time.perf_counter()
+                result = generate_batch(model, tok, [job], speculative=speculative)[0]
+                if isinstance(result, Exception):
+                    raise result
+                latencies.append(time.perf_counter() - t)
+                generated += result["generated_tokens"]
+                texts.append(result["text"])
+                suite.append(score_example(ex, result["text"])["avg"])
+            scores[name] = round(st.mean(suite), 4)
+
+    return {
+        "mode": mode,
+        "latency_s_mean": round(st.mean(latencies), 3),
+        "tokens_per_s": round(generated / sum(latencies), 2),
+        "generated_tokens": generated,
+        "forwards": counts["forwards"],
+        "tokens_per_forward": round(generated / max(counts["forwards"], 1), 3),
+        "proposed": counts["proposed"],
+        "acceptance_rate": round(counts["accepted"] / counts["proposed"], 4) if counts["proposed"] else None,
+        "score_avg": round(st.mean(scores.values()), 4),
+        "scores": scores,
+    }, texts
+
+
+def main():
+    p = argparse.ArgumentParser(description="Speculative decoding on the eval suites: acceptance rate, tokens per forward pass, speedup")
+    p.add_argument("--modes", nargs="+", default=["prompt_lookup"], choices=["prompt_lookup", "draft"])
+    p.add_argument("--draft", default=os.getenv("DRAFT_MODEL", ""), help="draft model for --modes draft")
+    p.add_argument("--lookup_tokens", type=int, default=10)
+    p.add_argument("--ngram_size", type=int, default=2)
+    p.add_argument("--draft_tokens", type=int, default=5)
+    p.add_argument("--max_tokens", type=int, default=128)
+    p.add_argument("--temperature", type=float, default=0.0, help="<= 0 (greedy) also checks outputs match exactly")
+    p.add_argument("--out", default="artifacts/bench/speculative.json")
+    args = p.parse_args()
+
+    from serve.loading import load_model, load_tokenizer
+    from serve.speculative import speculative_kwargs
+
+    tok = load_tokenizer(BASE)
+    model, weights = load_model(BASE, ADAPTER, MERGED)
+    print(f"Weights: {weights}")
+
+    # Warm-up so the first measured mode doesn't pay for lazy initialisation
+    from serve.batching import GenerationJob, generate_batch
+    generate_batch(model, tok, [GenerationJob(prompt="Warm up", max_tokens=4, temperature=0)])
+
+    print("Benchmarking off...")
+    baseline, base_texts = measure(model, tok, "off", None, args.max_tokens, args.temperature)
+    results = [baseline]
+    for mode in args.modes:
+        print(f"Benchmarking {mode}...")
+        kwargs = speculative_kwargs(mode, tok, args.lookup_tokens, args.ngram_size, args.draft, args.draft_tokens)
+        r, texts = measure(model, tok, mode, kwargs, args.max_tokens, args.temperature)
+        r["speedup"] = round(baseline["latency_s_mean"] / r["latency_s_mean"], 2)
+        if args.temperature <= 0:
+            r["identical_outputs"] = sum(a == b for a, b in zip(texts, base_texts)) / len(texts)
+        results.append(r)
+
+    print("\n" + "="*72)
+    print("SPECULATIVE DECODING BENCHMARK")
+    print("="*72)
+    print(f"{'mode':<14} {'lat s':>7} {'tok/s':>7} {'speedup':>8} {'tok/fwd':>8} {'accept':>7} {'same':>6} {'score':>6}")
+    for r in results:
+        accept = f"{r['acceptance_rate']:.1%}" if r["acceptance_rate"] is not None else "-"
+        same = f"{r['identical_outputs']:.0%}" if "identical_outputs" in r else "-"
+        print(f"{r['mode']:<14} {r['latency_s_mean']:>7} {r['tokens_per_s']:>7} {r.get('speedup', 1.0):>8} "
+              f"{r['tokens_per_forward']:>8} {accept:>7} {same:>6} {r['score_avg']:>6.2%}")
+    print("="*72)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Small random-weight stand-in for the served model, so benchmarks run anywhere in minutes.
+
+It keeps the real tokenizer (so prompt lengths, tokenisation and decoding
+costs are the real ones) and the model family and LoRA targets used in
+training, but with a few narrow layers. Weights are seeded, so every build
+of the same spec is identical.
+"""
+import os, json
+import torch
+
+STANDIN_SPEC = {"hidden_size": 256, "intermediate_size": 688, "num_hidden_layers": 4,
+                "num_attention_heads": 4, "num_key_value_heads": 4, "seed": 0}
+
+
+def make_standin(base, out_dir, spec=None):
+    """Build (or reuse) the stand-in under out_dir; returns (base_dir, adapter_dir)"""
+    from peft import LoraConfig, TaskType, get_peft_model
+    from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+    spec = {**STANDIN_SPEC, **(spec or {}), "tokenizer": base}
+    base_dir, adapter_dir = os.path.join(out_dir, "base"), os.path.join(out_dir, "sft")
+    spec_path = os.path.join(out_dir, "standin.json")
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            if json.load(f) == spec:
+                return base_dir, adapter_dir
+
+    tok = AutoTokenizer.from_pretrained(base, use_fast=True, token=os.getenv("HF_TOKEN") or None)
+    config = LlamaConfig(
+        vocab_size=len(tok),
+        hidden_size=spec["hidden_size"],
+        intermediate_size=spec["intermediate_size"],
+        num_hidden_layers=spec["num_hidden_layers"],
+        num_attention_heads=spec["num_attention_heads"],
+        num_key_value_heads=spec["num_key_value_heads"],
+        max_position_embeddings=4096,
+        bos_token_id=tok.bos_token_id,
+        eos_token_id=tok.eos_token_id,
+    )
+    torch.manual_seed(spec["seed"])
+    model = LlamaForCausalLM(config)
+    model.config.name_or_path = base_dir
+    model.save_pretrained(base_dir)
+    tok.save_pretrained(base_dir)
+
+    # Same LoRA shape as train/sft_lora_cpu.py, with non-zero weights so it changes the outputs
+    lora = LoraConfig(r=8, lora_alpha=16, task_type=TaskType.CAUSAL_LM, init_lora_weights=False,
+                      target_modules=["q_proj", "k_proj", "v_proj", "o_proj"])
+    get_peft_model(model, lora).save_pretrained(adapter_dir)
+    tok.save_pretrained(adapter_dir)
+
+    with open(spec_path, "w") as f:
+        json.dump(spec, f, indent=2)
+    return base_dir, adapter_dir
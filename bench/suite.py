@@ -0,0 +1,343 @@
+"""Reproducible performance suite: serving, training and data-pipeline throughput.
+
+    python bench/suite.py                  # stand-in model, everything
+    python bench/suite.py --only serving   # one section
+    python bench/suite.py --real           # BASE_MODEL / OUT_DIR / MERGED_DIR weights
+
+Results (plus the machine and library versions they were measured on) go to
+one JSON file; bench/compare.py checks them against a stored baseline.
+Each measurement is repeated and the median kept.
+"""
+import sys, os
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse, asyncio, json, platform, re, socket, subprocess, tempfile, time, statistics as st
+
+BASE = os.getenv("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+ADAPTER = os.getenv("OUT_DIR", "artifacts/sft")
+MERGED = os.getenv("MERGED_DIR", "artifacts/merged")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings that change performance; recorded with the results when set
+KNOBS = ("QUANTIZE", "BATCH_MAX_SIZE", "BATCH_WINDOW_MS", "PREFIX_CACHE_SIZE", "SPECULATIVE", "STRUCTURE_STOP",
+         "TOKENS_PER_BATCH", "GRAD_ACCUM_STEPS", "PACKING", "PACK_BLOCK_SIZE", "MAX_INPUT_TOKENS",
+         "MAX_TARGET_TOKENS", "OMP_NUM_THREADS", "MKL_NUM_THREADS")
+
+FILLER = (
+    "Arsenal's shot volume rose to 14 per match while accuracy dipped to 31%.",
+    "Chelsea conceded 0.7 xG per game across the last five fixtures.",
+    "Manchester City completed 84% of passes in the final third.",
+    "Brighton's pressing recovered the ball 9 times in the attacking half.",
+    "Set pieces produced 3 of the last 8 goals scored at the Emirates.",
+    "Foord completed 6 progressive carries, the most of any forward this week.",
+)
+
+
+def environment(model, spec=None):
+    """Where and with what the numbers were measured"""
+    import torch, transformers, peft
+
+    def git(*cmd):
+        try:
+            return subprocess.run(["git", *cmd], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    except OSError:
+        pass
+    try:
+        usable = len(os.sched_getaffinity(0))
+    except AttributeError:
+        usable = os.cpu_count()
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": git("rev-parse", "HEAD"),
+        "git_dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu": cpu,
+        "cpu_count": os.cpu_count(),
+        "cpu_usable": usable,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "transformers": transformers.__version__,
+        "peft": peft.__version__,
+        "model": model,
+        "standin_spec": spec,
+        "settings": {k: os.environ[k] for k in KNOBS if k in os.environ},
+    }
+
+
+def metric(metrics, name, value, better, unit):
+    metrics[name] = {"value": round(value, 4), "better": better, "unit": unit}
+
+
+def median_run(fn, repeats):
+    """Run fn() repeats times; each measured (float) field becomes its median"""
+    runs = [fn() for _ in range(repeats)]
+    out = dict(runs[-1])
+    for key, value in runs[0].items():
+        if isinstance(value, float):
+            out[key] = st.median(r[key] for r in runs)
+    return out
+
+
+def read_posts():
+    with open(os.path.join(ROOT, "data/raw/sample.jsonl"), encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# --- serving -----------------------------------------------------------------------------
+def make_prompt(tok, target, i, posts):
+    """A house-style prompt of about `target` tokens (the CONTEXT is padded with stats lines)"""
+    from scripts.build_sft_pairs import classify, make_instruction
+
+    post = posts[i % len(posts)]
+    title = f"{post['title']} ({i})"
+    kind = classify(post["title"], post["body"])
+    body, n = post["body"], 0
+    prompt = make_instruction(kind, title, body)
+    if len(tok(prompt)["input_ids"]) > target:
+        # Shorter than the house template: a bare context + question, cut to length
+        ids = tok(f"<CONTEXT>{body} {' '.join(FILLER)}</CONTEXT>\n\nSummarise the key numbers.")["input_ids"]
+        return tok.decode(ids[1:target] if ids[0] == tok.bos_token_id else ids[:target])
+    while len(tok(prompt)["input_ids"]) < target:
+        body += " " + FILLER[n % len(FILLER)]
+        n += 1
+        prompt = make_instruction(kind, title, body)
+    return prompt
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(env, port, timeout=600):
+    """Launch the API in a subprocess and wait until the model has loaded"""
+    import httpx
+
+    log = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "serve.app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            log.seek(0)
+            raise RuntimeError(f"API exited with {proc.returncode}:\n{log.read().decode(errors='replace')[-2000:]}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/readyz", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    proc.kill()
+    raise TimeoutError("API did not come up")
+
+
+async def fire(url, prompts, concurrency, max_tokens):
+    """Send every prompt with at most `concurrency` requests in flight"""
+    import httpx
+
+    gate = asyncio.Semaphore(concurrency)
+    latencies, tokens = [], 0
+
+    async def one(client, prompt):
+        nonlocal tokens
+        async with gate:
+            t = time.perf_counter()
+            r = await client.post(url, json={"prompt": prompt, "max_tokens": max_tokens, "temperature": 0,
+                                             "kind": "none"})
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - t)
+            tokens += r.json()["generated_tokens"]
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client, p) for p in prompts))
+        wall = time.perf_counter() - started
+    return latencies, tokens, wall
+
+
+def stage_totals(base_url):
+    """{stage: (sum seconds, count)} from the API's /metrics"""
+    import httpx
+
+    text = httpx.get(f"{base_url}/metrics").text
+    totals = {}
+    for kind, stage, value in re.findall(r'wsl_stage_seconds_(sum|count)\{stage="(\w+)"\} (\S+)', text):
+        s, n = totals.get(stage, (0.0, 0))
+        totals[stage] = (s + float(value), n) if kind == "sum" else (s, n + int(float(value)))
+    return totals
+
+
+def bench_serving(args, weights, metrics):
+    from serve.loading import load_tokenizer
+
+    tok = load_tokenizer(weights["BASE_MODEL"])
+    posts = read_posts()
+    port = free_port()
+    env = {**os.environ, **weights, "RESPONSE_CACHE": "0"}
+    base_url, url = f"http://127.0.0.1:{port}", f"http://127.0.0.1:{port}/generate"
+
+    print("Starting API...")
+    proc = start_server(env, port)
+    rows = []
+    try:
+        for target in args.prompt_tokens:
+            warm = [make_prompt(tok, target, 10_000 + i, posts) for i in range(2)]
+            asyncio.run(fire(url, warm, 1, args.max_tokens))
+            for concurrency in args.concurrency:
+                n = max(args.requests, 2 * concurrency)
+                prompts = [make_prompt(tok, target, i, posts) for i in range(n)]
+                prompt_len = st.mean(len(tok(p)["input_ids"]) for p in prompts)
+
+                def run():
+                    before = stage_totals(base_url)
+                    latencies, tokens, wall = asyncio.run(fire(url, prompts, concurrency, args.max_tokens))
+                    after = stage_totals(base_url)
+                    latencies.sort()
+                    row = {
+                        "latency_p50_s": latencies[len(latencies) // 2],
+                        "latency_p95_s": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+                        "requests_per_s": len(prompts) / wall,
+                        "tokens_per_s": tokens / wall,
+                    }
+                    for stage, (s, c) in after.items():
+                        ds, dc = s - before.get(stage, (0.0, 0))[0], c - before.get(stage, (0.0, 0))[1]
+                        if dc:
+                            row[f"{stage}_ms"] = 1000 * ds / dc
+                    return row
+
+                row = median_run(run, args.repeats)
+                row.update(prompt_tokens=target, prompt_tokens_mean=round(prompt_len, 1),
+                           concurrency=concurrency, requests=n)
+                rows.append(row)
+                name = f"serving/p{target}/c{concurrency}"
+                metric(metrics, f"{name}/latency_p50_s", row["latency_p50_s"], "lower", "s")
+                metric(metrics, f"{name}/latency_p95_s", row["latency_p95_s"], "lower", "s")
+                metric(metrics, f"{name}/requests_per_s", row["requests_per_s"], "higher", "req/s")
+                metric(metrics, f"{name}/tokens_per_s", row["tokens_per_s"], "higher", "tok/s")
+                print(f"  prompt ~{target:>5} tok, concurrency {concurrency:>2}: "
+                      f"p50 {row['latency_p50_s']:.3f}s, p95 {row['latency_p95_s']:.3f}s, "
+                      f"{row['requests_per_s']:.2f} req/s, {row['tokens_per_s']:.1f} tok/s")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    return rows
+
+
+# --- training ----------------------------------------------------------------------------
+def bench_training(args, weights, metrics, workdir):
+    with open(os.path.join(ROOT, "data/processed/sft_all.jsonl"), encoding="utf-8") as f:
+        pairs = [json.loads(line) for line in f if line.strip()]
+    train_path, val_path = os.path.join(workdir, "train.jsonl"), os.path.join(workdir, "val.jsonl")
+    for path, n in ((train_path, args.train_examples), (val_path, 4)):
+        with open(path, "w", encoding="utf-8") as f:
+            for i in range(n):
+                f.write(json.dumps(pairs[i % len(pairs)], ensure_ascii=False) + "\n")
+
+    def run():
+        out = tempfile.mkdtemp(dir=workdir)
+        env = {**os.environ, "BASE_MODEL": weights["BASE_MODEL"], "OUT_DIR": os.path.join(out, "sft"),
+               "TRAIN_JSONL": train_path, "VAL_JSONL": val_path, "TOKEN_CACHE_DIR": os.path.join(out, "cache"),
+               "TRAIN_METRICS_OUT": os.path.join(out, "metrics.json")}
+        subprocess.run([sys.executable, "train/sft_lora_cpu.py"], cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(env["TRAIN_METRICS_OUT"]) as f:
+            return json.load(f)
+
+    print("Training...")
+    row = median_run(run, args.repeats)
+    row["examples"] = args.train_examples
+    metric(metrics, "training/steps_per_s", row["steps_per_s"], "higher", "steps/s")
+    metric(metrics, "training/tokens_per_s", row["tokens_per_s"], "higher", "tok/s")
+    print(f"  {row['steps_per_s']:.3f} optimiser steps/s, {row['tokens_per_s']:,.0f} tokens/s "
+          f"({args.train_examples} examples, grad accum {row['grad_accum']})")
+    return row
+
+
+# --- data pipeline -----------------------------------------------------------------------
+def bench_pipeline(args, metrics, workdir):
+    posts = read_posts()
+    raw = os.path.join(workdir, "raw.jsonl")
+    with open(raw, "w", encoding="utf-8") as f:
+        for i in range(args.pipeline_records):
+            d = dict(posts[i % len(posts)])
+            d["id"] = f"{d['id']}-{i}"
+            d["body"] = f"{d['body']} {FILLER[i % len(FILLER)]} Matchweek {i}."
+            f.write(json.dumps(d, ensure_ascii=False) + "\n")
+
+    def run():
+        out = tempfile.mkdtemp(dir=workdir)
+        cmd = [sys.executable, "scripts/pipeline.py", "--inputs", raw, "--workers", str(args.pipeline_workers)]
+        for flag in ("interim_out", "all_out", "train_out", "val_out"):
+            cmd += [f"--{flag}", os.path.join(out, f"{flag}.jsonl")]
+        started = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wall = time.perf_counter() - started
+        return {"wall_s": wall, "records_per_s": args.pipeline_records / wall}
+
+    print("Data pipeline...")
+    row = median_run(run, args.repeats)
+    row.update(records=args.pipeline_records, workers=args.pipeline_workers)
+    metric(metrics, "pipeline/records_per_s", row["records_per_s"], "higher", "records/s")
+    print(f"  {row['records_per_s']:,.0f} records/s ({args.pipeline_records} records, {args.pipeline_workers} workers)")
+    return row
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark serving latency/throughput, training and the data pipeline")
+    p.add_argument("--only", nargs="+", choices=["serving", "training", "pipeline"],
+                   default=["serving", "training", "pipeline"])
+    p.add_argument("--real", action="store_true", help="use BASE_MODEL/OUT_DIR/MERGED_DIR instead of the stand-in")
+    p.add_argument("--standin_dir", default="artifacts/bench/standin")
+    p.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 8])
+    p.add_argument("--prompt_tokens", nargs="+", type=int, default=[64, 384, 1024])
+    p.add_argument("--requests", type=int, default=16, help="requests per concurrency level (at least 2x the level)")
+    p.add_argument("--max_tokens", type=int, default=64)
+    p.add_argument("--train_examples", type=int, default=64)
+    p.add_argument("--pipeline_records", type=int, default=20000)
+    p.add_argument("--pipeline_workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--repeats", type=int, default=3, help="runs per measurement; the median is kept")
+    p.add_argument("--out", default="artifacts/bench/results.json")
+    args = p.parse_args()
+
+    spec = None
+    if args.real:
+        weights = {"BASE_MODEL": BASE, "OUT_DIR": ADAPTER, "MERGED_DIR": MERGED}
+        model = BASE
+    else:
+        from bench.standin import STANDIN_SPEC, make_standin
+        base_dir, adapter_dir = make_standin(BASE, os.path.abspath(args.standin_dir))
+        # No merged checkpoint: the API serves the stand-in base + adapter
+        weights = {"BASE_MODEL": base_dir, "OUT_DIR": adapter_dir, "MERGED_DIR": ""}
+        model, spec = f"standin:{BASE}", STANDIN_SPEC
+
+    report = {"env": environment(model, spec), "config": vars(args), "results": {}, "metrics": {}}
+    with tempfile.TemporaryDirectory(prefix="wsl-bench-") as workdir:
+        if "serving" in args.only:
+            report["results"]["serving"] = bench_serving(args, weights, report["metrics"])
+        if "training" in args.only:
+            report["results"]["training"] = bench_training(args, weights, report["metrics"], workdir)
+        if "pipeline" in args.only:
+            report["results"]["pipeline"] = bench_pipeline(args, report["metrics"], workdir)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,73 +2,247 @@ import sys, os
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import argparse, json, requests, statistics as st
-from eval.metrics import (
-    json_validity, 
-    contains_numbers_from_table, 
-    refusal,
-    has_numbered_bullets,
-    has_hashtags
-)
-
-p = argparse.ArgumentParser()
-p.add_argument("--suite", default="all")
-p.add_argument("--endpoint", default="http://localhost:8000/generate")
-args = p.parse_args()
-
-def infer(prompt, max_tokens=200):
-    """Call the API to generate text"""
-    r = requests.post(args.endpoint, json={
-        "prompt": prompt,
-        "max_tokens": max_tokens
-    })
-    r.raise_for_status()
-    return r.json()["text"]
-
-def run_suite(path):
-    """Run evaluation on a test suite"""
+import argparse, asyncio, json, time, statistics as st
+import httpx
+from eval.metrics import score_example
+
+# Suite name -> examples file
+SUITES = {
+    "task": "eval/suites/task_qa.jsonl",
+    "extract": "eval/suites/extraction.jsonl",
+    "safety": "eval/suites/safety_refusal.jsonl",
+}
+
+# Worth retrying: overloaded or restarting server
+RETRY_STATUSES = {429, 502, 503, 504}
+
+def load_suite(path):
+    """Read a suite's examples"""
+    return [json.loads(line) for line in open(path, "r", encoding="utf-8")]
+
+def selected_suites(name):
+    """Suite files for --suite (a suite name or "all")"""
+    return [path for key, path in SUITES.items() if name in ("all", key)]
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+def response_format(args, ex):
+    """Ask the server for constrained JSON on examples scored for JSON validity"""
+    return "json" if ex.get("expects_json") and not args.no_json_constraint else None
+
+def structure_settings(args):
+    """Structure stopping a run really used, for the results header.
+
+    An unset --kind isn't sent, so it follows STRUCTURE_STOP: the server's
+    (read from /model-info) for http, this process's for local.
+    """
+    kind, source = args.kind, "--kind"
+    if kind is None:
+        source = "STRUCTURE_STOP"
+        if args.backend == "local":
+            on = os.getenv("STRUCTURE_STOP", "0") == "1"
+        else:
+            try:
+                info = httpx.get(args.endpoint.rsplit("/", 1)[0] + "/model-info", timeout=args.timeout)
+                on = info.json()["structure_stop"]
+            except (httpx.HTTPError, ValueError, KeyError):
+                on = None
+        kind = "unknown" if on is None else ("auto" if on else "none")
+    return {"kind": kind, "kind_from": source, "stop": args.stop or []}
+
+async def infer(client, args, prompt, response_format=None):
+    """Call the API to generate text, retrying transient failures.
+
+    Returns (response json, attempts).
+    """
+    payload = {"prompt": prompt, "max_tokens": args.max_tokens}
+    if args.temperature is not None:
+        payload["temperature"] = args.temperature
+    if args.seed is not None:
+        payload["seed"] = args.seed
+    if response_format:
+        payload["response_format"] = response_format
+    if args.kind is not None:
+        payload["kind"] = args.kind
+    if args.stop:
+        payload["stop"] = args.stop
+
+    for attempt in range(args.retries + 1):
+        delay = 0.5 * 2 ** attempt
+        try:
+            r = await client.post(args.endpoint, json=payload, timeout=args.timeout)
+            if r.status_code in RETRY_STATUSES and attempt < args.retries:
+                delay = float(r.headers.get("Retry-After", delay))
+                await asyncio.sleep(delay)
+                continue
+            r.raise_for_status()
+            return r.json(), attempt + 1
+        except httpx.TransportError:
+            if attempt == args.retries:
+                raise
+            await asyncio.sleep(delay)
+
+async def run_example(client, sem, args, suite, ex):
+    """Generate and score one example; failures are recorded, not raised"""
+    async with sem:
+        t0 = time.perf_counter()
+        record = {**ex, "suite": suite}
+        try:
+            resp, attempts = await infer(client, args, ex["prompt"], response_format(args, ex))
+            out = resp["text"]
+            record.update(attempts=attempts, generated_tokens=resp.get("generated_tokens"))
+        except Exception as e:
+            out = ""
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["latency_s"] = round(time.perf_counter() - t0, 4)
+        record["output"] = out
+        record["scores"] = score_example(ex, out)
+
+    print_record(record)
+    return record
+
+def print_record(record):
+    print(f"\n[{record['suite']}] Test: {record.get('name', 'unnamed')} ({record['latency_s']:.2f}s)")
+    if "error" in record:
+        print(f"Error: {record['error']}")
+    else:
+        print(f"Output preview: {record['output'][:100]}...")
+    print(f"Scores: {record['scores']}")
+
+async def run_all(args):
+    """Run every selected suite concurrently over one pooled HTTP client"""
+    tasks = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits) as client:
+        for path in selected_suites(args.suite):
+            for ex in load_suite(path):
+                tasks.append(run_example(client, sem, args, path, ex))
+        records = await asyncio.gather(*tasks)
+    return records, time.perf_counter() - started
+
+def run_local(args, kind):
+    """Load the model in-process and run all suite prompts in padded batches (no server)"""
+    from serve.loading import load_model, load_tokenizer
+    from serve.batching import GenerationJob, generate_batch
+    from serve.stopping import resolve_kind
+
+    base = os.getenv("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    adapter = os.getenv("OUT_DIR", "artifacts/sft")
+    merged = os.getenv("MERGED_DIR", "artifacts/merged")
+
+    print("="*60)
+    print("LOADING MODEL FOR LOCAL EVAL...")
+    print("="*60)
+    tok = load_tokenizer(base)
+    model, weights = load_model(base, adapter, merged)
+    print(f"Weights: {merged if weights == 'merged' else adapter} ({weights})")
+
+    examples = [(path, ex) for path in selected_suites(args.suite) for ex in load_suite(path)]
+    sampling = {}
+    if args.temperature is not None:
+        sampling["temperature"] = args.temperature
+    if args.seed is not None:
+        sampling["seed"] = args.seed
+
+    records = []
+    started = time.perf_counter()
+    for i in range(0, len(examples), args.batch_size):
+        chunk = examples[i:i + args.batch_size]
+        # Same structure/stop-string settings the server applies for --kind/--stop
+        jobs = [GenerationJob(prompt=ex["prompt"], max_tokens=args.max_tokens,
+                              response_format=response_format(args, ex), stop=args.stop or None,
+                              kind=resolve_kind(kind, ex["prompt"]), **sampling) for _, ex in chunk]
+        t0 = time.perf_counter()
+        results = generate_batch(model, tok, jobs)
+        # Every row of a batch completes together
+        latency = round(time.perf_counter() - t0, 4)
+        for (path, ex), result in zip(chunk, results):
+            record = {**ex, "suite": path}
+            if isinstance(result, Exception):
+                out = ""
+                record["error"] = f"{type(result).__name__}: {result}"
+            else:
+                out = result["text"]
+                record["generated_tokens"] = result["generated_tokens"]
+            record.update(latency_s=latency, output=out, scores=score_example(ex, out))
+            print_record(record)
+            records.append(record)
+    return records, time.perf_counter() - started
+
+def report(records, wall, settings):
+    """Print the structure-stopping settings, per-suite quality, latency percentiles and throughput"""
     print(f"\n{'='*60}")
-    print(f"RUNNING: {path}")
-    print(f"{'='*60}")
-    
-    scores = []
-    for line in open(path, "r", encoding="utf-8"):
-        ex = json.loads(line)
-        print(f"\nTest: {ex.get('name', 'unnamed')}")
-        
-        out = infer(ex["prompt"])
-        print(f"Output preview: {out[:100]}...")
-        
-        s = {
-            "json": json_validity(out) if ex.get("expects_json") else 1.0,
-            "facts": contains_numbers_from_table(out, ex.get("nums", [])),
-            "refusal": refusal(out) if ex.get("unsafe") else 1.0,
-            "bullets": has_numbered_bullets(out) if ex.get("expects_bullets") else 1.0,
-            "hashtags": has_hashtags(out) if ex.get("expects_hashtags") else 1.0,
-        }
-        s["avg"] = st.mean(s.values())
-        scores.append(s)
-        
-        print(f"Scores: {s}")
-    
-    avg_score = st.mean([x["avg"] for x in scores])
+    print(f"Structure stopping: kind={settings['kind']} (from {settings['kind_from']}), "
+          f"stop={settings['stop']}")
+    for path in dict.fromkeys(r["suite"] for r in records):
+        scores = [r["scores"]["avg"] for r in records if r["suite"] == path]
+        print(f"\n{'='*60}")
+        print(f"Suite: {path}")
+        print(f"Tests: {len(scores)}")
+        print(f"Average Score: {st.mean(scores):.2%}")
+        print(f"{'='*60}")
+
+    ok = [r for r in records if "error" not in r]
+    latencies = [r["latency_s"] for r in ok]
+    tokens = sum(r.get("generated_tokens") or 0 for r in ok)
     print(f"\n{'='*60}")
-    print(f"Suite: {path}")
-    print(f"Tests: {len(scores)}")
-    print(f"Average Score: {avg_score:.2%}")
+    print("LATENCY & THROUGHPUT")
     print(f"{'='*60}")
-    return scores
+    print(f"Requests: {len(records)} ({len(records) - len(ok)} failed)")
+    if latencies:
+        print(f"Latency p50/p95/p99: {percentile(latencies, 0.50):.2f}s / "
+              f"{percentile(latencies, 0.95):.2f}s / {percentile(latencies, 0.99):.2f}s")
+    print(f"Wall time: {wall:.2f}s")
+    print(f"Throughput: {len(ok) / wall:.2f} req/s, {tokens / wall:.1f} tokens/s")
+    if records:
+        print(f"Overall Score: {st.mean(r['scores']['avg'] for r in records):.2%}")
 
-# Run specified suites
-if args.suite in ("all", "task"):
-    run_suite("eval/suites/task_qa.jsonl")
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--suite", default="all")
+    p.add_argument("--backend", choices=["http", "local"], default="http",
+                   help="http: call --endpoint; local: load the model in-process")
+    p.add_argument("--endpoint", default="http://localhost:8000/generate")
+    p.add_argument("--temperature", type=float, default=None, help="0 = greedy (cacheable)")
+    p.add_argument("--seed", type=int, default=None, help="fixed seed makes sampled runs cacheable")
+    p.add_argument("--max_tokens", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=4, help="requests in flight at once (http)")
+    p.add_argument("--timeout", type=float, default=300.0, help="per-request timeout (seconds)")
+    p.add_argument("--retries", type=int, default=2)
+    p.add_argument("--no_json_constraint", action="store_true",
+                   help="don't request constrained JSON decoding for expects_json examples")
+    p.add_argument("--kind", default=None, choices=["auto", "none", "preview", "recap", "thread", "caption"],
+                   help="structure stopping for both backends (auto: read from the prompt's TASK line); "
+                        "unset follows STRUCTURE_STOP")
+    p.add_argument("--stop", action="append", default=None, help="stop string (repeatable), both backends")
+    p.add_argument("--batch_size", type=int, default=8, help="prompts per generate call (local)")
+    p.add_argument("--out", default="artifacts/eval/results.jsonl", help="per-example results")
+    args = p.parse_args()
 
-if args.suite in ("all", "extract"):
-    run_suite("eval/suites/extraction.jsonl")
+    settings = structure_settings(args)
+    if args.backend == "local":
+        records, wall = run_local(args, settings["kind"])
+    else:
+        records, wall = asyncio.run(run_all(args))
+    report(records, wall, settings)
 
-if args.suite in ("all", "safety"):
-    run_suite("eval/suites/safety_refusal.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        for r in records:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+    print(f"\n{'='*60}")
+    print("EVALUATION COMPLETE")
+    print(f"Results: {args.out}")
+    print(f"{'='*60}")
 
-print(f"\n{'='*60}")
-print("EVALUATION COMPLETE")
-print(f"{'='*60}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import sys, os
+# Add parent directory to path so we can import eval.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse, json, time
+from collections import defaultdict
+import numpy as np
+from eval.metrics import METRICS, score_batch
+
+def read_chunks(path, size):
+    chunk = []
+    for line in open(path, "r", encoding="utf-8"):
+        if line.strip():
+            chunk.append(json.loads(line))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def main():
+    p = argparse.ArgumentParser(description="Re-score stored generations without regenerating them")
+    p.add_argument("--in_jsonl", default="artifacts/eval/results.jsonl",
+                   help="records with suite expectations plus the generated text (run_eval.py --out)")
+    p.add_argument("--out", default=None, help="write the records back with fresh scores")
+    p.add_argument("--output_field", default="output", help="record field holding the generation")
+    p.add_argument("--group_by", default="suite", help="record field to average scores over")
+    p.add_argument("--chunk_size", type=int, default=10000)
+    args = p.parse_args()
+
+    sums = defaultdict(lambda: np.zeros(len(METRICS) + 1))
+    counts = defaultdict(int)
+    out = None
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        out = open(args.out, "w", encoding="utf-8")
+
+    t0 = time.perf_counter()
+    n = 0
+    for records in read_chunks(args.in_jsonl, args.chunk_size):
+        scores = score_batch(records, [r.get(args.output_field) or "" for r in records])
+        scores = np.hstack([scores, scores.mean(axis=1, keepdims=True)])
+        for r, row in zip(records, scores):
+            group = r.get(args.group_by, "all")
+            sums[group] += row
+            counts[group] += 1
+            if out:
+                r["scores"] = dict(zip(METRICS + ("avg",), row.tolist()))
+                out.write(json.dumps(r, ensure_ascii=False) + "\n")
+        n += len(records)
+    elapsed = time.perf_counter() - t0
+    if out:
+        out.close()
+
+    width = max([len(args.group_by)] + [len(str(g)) for g in sums]) + 2
+    header = f"{args.group_by:<{width}}{'rows':>8}" + "".join(f"{m:>10}" for m in METRICS + ("avg",))
+    print(header)
+    print("-" * len(header))
+    for group in sorted(sums, key=str):
+        means = sums[group] / counts[group]
+        print(f"{str(group):<{width}}{counts[group]:>8}" + "".join(f"{v:>10.2%}" for v in means))
+    print(f"\nScored {n} rows in {elapsed:.2f}s ({n / max(elapsed, 1e-9):,.0f} rows/s)")
+    if out:
+        print(f"Results: {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -70,6 +70,15 @@ CAPTION_TEMPLATE = {
     "verdict": "One paragraph, 2–3 sentences, 1–2 hashtags."
 }
 
+# Task line per content kind, and the most numbered bullets each kind's template asks for
+TASKS = {
+    "preview": "Draft a pre-match preview",
+    "recap": "Write a post-match recap",
+    "thread": "Turn the context into a weekly thread",
+    "caption": "Write a concise social caption",
+}
+BULLET_LIMITS = {"preview": 7, "recap": 7, "thread": 6, "caption": 0}
+
 # --- Helpers ---------------------------------------------------------------------
 def classify(title: str, body: str) -> str:
     t = (title + " " + body[:200]).lower()
@@ -109,13 +118,17 @@ def bullet_style_guidance(kind: str) -> str:
         f"\n### RULES\n{rules}\n"
     )
 
+def kind_from_instruction(text: str):
+    """Content kind an instruction built by make_instruction asks for, or None"""
+    for kind, task in TASKS.items():
+        if f"### TASK\n{task}" in text:
+            return kind
+    return None
+
 def make_instruction(kind: str, title: str, body: str):
     tags = " ".join(extract_hashtags(title + " " + body))
     style = bullet_style_guidance(kind)
-    task = "Draft a pre-match preview" if kind=="preview" else \
-           "Write a post-match recap" if kind=="recap" else \
-           "Turn the context into a weekly thread" if kind=="thread" else \
-           "Write a concise social caption"
+    task = TASKS.get(kind, TASKS["caption"])
     return (
         f"<s>{SYSTEM_CUE}</s>\n"
         f"<TITLE>{title}</TITLE>\n"
@@ -129,27 +142,34 @@ def make_instruction(kind: str, title: str, body: str):
         f"- End with the required verdict/closer line.\n"
     )
 
-# --- Main ------------------------------------------------------------------------
-p = argparse.ArgumentParser()
-p.add_argument("--in_jsonl", default="data/interim/all_posts.jsonl")
-p.add_argument("--out_jsonl", default="data/processed/sft_all.jsonl")
-args = p.parse_args()
-
-pathlib.Path(args.out_jsonl).parent.mkdir(parents=True, exist_ok=True)
-
-w = open(args.out_jsonl, "w", encoding="utf-8")
-for line in open(args.in_jsonl, "r", encoding="utf-8"):
-    d = json.loads(line)
+def build_pair(d: dict) -> dict:
+    """SFT example for a normalised post"""
     title, body = d["title"], d["body"]
     kind = classify(title, body)
     instruction = make_instruction(kind, title, body)
     # Supervision target: your original text (style learning)
-    ex = {
+    return {
         "instruction": instruction,
         "output": body,
         "meta": {"type": kind, "title": title, "hashtags": extract_hashtags(title + " " + body)}
     }
-    w.write(json.dumps(ex, ensure_ascii=False) + "\n")
 
-w.close()
-print("Wrote", args.out_jsonl)
+# --- Main ------------------------------------------------------------------------
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--in_jsonl", default="data/interim/all_posts.jsonl")
+    p.add_argument("--out_jsonl", default="data/processed/sft_all.jsonl")
+    args = p.parse_args()
+
+    pathlib.Path(args.out_jsonl).parent.mkdir(parents=True, exist_ok=True)
+
+    w = open(args.out_jsonl, "w", encoding="utf-8")
+    for line in open(args.in_jsonl, "r", encoding="utf-8"):
+        ex = build_pair(json.loads(line))
+        w.write(json.dumps(ex, ensure_ascii=False) + "\n")
+
+    w.close()
+    print("Wrote", args.out_jsonl)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os, json, time, sqlite3, hashlib
+
+def processing_fingerprint(*parts) -> str:
+    """Identity of the processing setup: the stage source files plus any settings.
+
+    Mixed into every content hash, so editing clean/classify/make_instruction or
+    changing the split ratio/seed re-processes records instead of reusing stale output.
+    """
+    h = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in ("normalize_posts.py", "build_sft_pairs.py"):
+        with open(os.path.join(here, name), "rb") as f:
+            h.update(f.read())
+    h.update(json.dumps(parts, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:16]
+
+def content_hash(line: str, fingerprint: str) -> str:
+    """Content address of a raw JSONL record under a processing fingerprint"""
+    return hashlib.sha1(f"{fingerprint}\n{line.rstrip()}".encode("utf-8")).hexdigest()
+
+class Manifest:
+    """Persistent record of processed posts for incremental ingestion.
+
+    Every raw line seen is remembered by content hash so unchanged records are
+    skipped before parsing; every post key keeps its latest processed output
+    (normalised post, SFT pair, split), so the output files can be rewritten
+    from here without re-running any stage. Rows keep their first-seen order.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS hashes (hash TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS records (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                run INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                kind TEXT, split TEXT, post TEXT, pair TEXT
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                run INTEGER PRIMARY KEY AUTOINCREMENT,
+                started REAL, inputs TEXT, stats TEXT
+            );
+        """)
+
+    def begin_run(self, inputs) -> int:
+        cur = self.db.execute("INSERT INTO runs (started, inputs) VALUES (?, ?)", (time.time(), json.dumps(inputs)))
+        return cur.lastrowid
+
+    def end_run(self, run, stats):
+        self.db.execute("UPDATE runs SET stats = ? WHERE run = ?", (json.dumps(stats), run))
+        self.db.commit()
+
+    def add_hash(self, h) -> bool:
+        """Remember a raw record's content hash; True if it had not been processed before"""
+        return self.db.execute("INSERT OR IGNORE INTO hashes VALUES (?)", (h,)).rowcount == 1
+
+    def known_hash(self, h) -> bool:
+        return self.db.execute("SELECT 1 FROM hashes WHERE hash = ?", (h,)).fetchone() is not None
+
+    def last_run(self, key):
+        """Run that last wrote key, or None if the key is new"""
+        row = self.db.execute("SELECT run FROM records WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, run, h, status, kind=None, split=None, post=None, pair=None):
+        """Insert or replace the processed output for key, keeping its original position"""
+        self.db.execute(
+            "INSERT INTO records (key, run, hash, status, kind, split, post, pair) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET run=excluded.run, hash=excluded.hash, status=excluded.status, "
+            "kind=excluded.kind, split=excluded.split, post=excluded.post, pair=excluded.pair",
+            (key, run, h, status, kind, split, post, pair),
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def kept(self):
+        """(kind, post line, pair line, split) for every kept record, in first-seen order"""
+        return self.db.execute("SELECT kind, post, pair, split FROM records WHERE status = 'kept' ORDER BY seq")
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,161 @@
+import os, re, zlib
+import numpy as np
+
+SHINGLE_WORDS = 3
+DEFAULT_THRESHOLD = 0.8
+_WORD = re.compile(r"\w+")
+
+def shingles(text: str, k: int = SHINGLE_WORDS):
+    """Set of k-word shingles over the lower-cased words of text"""
+    words = _WORD.findall(text.lower())
+    if len(words) <= k:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+def make_permutations(num_perm: int, seed: int = 1):
+    """Random (a, b) for num_perm multiply-shift hash functions"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+def minhash_signature(text: str, a, b) -> np.ndarray:
+    """MinHash signature (uint32, one value per permutation) of text's shingles"""
+    hv = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles(text)), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        h = (hv[:, None] * a[None, :] + b[None, :]) >> np.uint64(32)
+    return h.min(axis=0).astype(np.uint32)
+
+def lsh_params(threshold: float, num_perm: int):
+    """(bands, rows) minimising the false positive + false negative area around threshold"""
+    s = np.linspace(0, 1, 501)
+    best = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        rows = num_perm // bands
+        p = 1 - (1 - s ** rows) ** bands
+        fp = p[s < threshold].mean() * threshold
+        fn = (1 - p[s >= threshold]).mean() * (1 - threshold)
+        if best is None or fp + fn < best[0]:
+            best = (fp + fn, bands, rows)
+    return best[1], best[2]
+
+class NearDupIndex:
+    """MinHash + LSH index of post bodies for near-duplicate detection.
+
+    Each body becomes a MinHash signature; signatures are cut into bands and
+    hashed into per-band buckets, so a query only compares against posts that
+    share at least one band (roughly linear overall instead of pairwise). A
+    candidate counts as a duplicate when its estimated Jaccard similarity is at
+    least threshold. Signatures persist to .npz; buckets are rebuilt on load.
+    """
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=128, seed=1):
+        self.threshold = float(threshold)
+        self.num_perm = int(num_perm)
+        self.seed = int(seed)
+        self.a, self.b = make_permutations(self.num_perm, self.seed)
+        self.bands, self.rows = lsh_params(self.threshold, self.num_perm)
+        self.keys, self.sigs = [], []
+        self._rows_by_key = {}
+        self._buckets = [{} for _ in range(self.bands)]
+
+    def __len__(self):
+        return len(self._rows_by_key)
+
+    def __contains__(self, key):
+        return key in self._rows_by_key
+
+    def signature(self, text: str) -> np.ndarray:
+        return minhash_signature(text, self.a, self.b)
+
+    def _band_keys(self, sig):
+        r = self.rows
+        return [hash(sig[i * r:(i + 1) * r].tobytes()) for i in range(self.bands)]
+
+    def query(self, sig):
+        """(key, estimated Jaccard) of the most similar indexed post at or above threshold, else None"""
+        candidates = set()
+        for bucket, bk in zip(self._buckets, self._band_keys(sig)):
+            hit = bucket.get(bk)
+            if hit is not None:
+                candidates.update(hit)
+        if not candidates:
+            return None
+        rows = np.fromiter(candidates, dtype=np.int64)
+        sims = (np.stack([self.sigs[i] for i in rows]) == sig).mean(axis=1)
+        best = int(sims.argmax())
+        if sims[best] < self.threshold:
+            return None
+        return self.keys[rows[best]], float(sims[best])
+
+    def add(self, key, sig):
+        if key in self._rows_by_key:
+            return
+        row = len(self.keys)
+        self.keys.append(key)
+        self.sigs.append(sig)
+        self._rows_by_key[key] = row
+        for bucket, bk in zip(self._buckets, self._band_keys(sig)):
+            bucket.setdefault(bk, []).append(row)
+
+    def remove(self, key):
+        """Drop a post from the index (its row is left as a tombstone that save() skips)"""
+        row = self._rows_by_key.pop(key, None)
+        if row is None:
+            return
+        for bucket, bk in zip(self._buckets, self._band_keys(self.sigs[row])):
+            rows = bucket[bk]
+            rows.remove(row)
+            if not rows:
+                del bucket[bk]
+        self.keys[row] = None
+
+    def check(self, key, sig):
+        """Match for a new or edited post, indexing it if it is not a near-duplicate.
+
+        Posts already in the index with the same signature are never reported
+        as duplicates of themselves, so re-running over the same input is a
+        no-op. A post whose content changed since it was indexed is dropped
+        and checked again with its new signature, as a full rebuild would.
+        """
+        row = self._rows_by_key.get(key)
+        if row is not None:
+            if np.array_equal(self.sigs[row], sig):
+                return None
+            self.remove(key)
+        match = self.query(sig)
+        if match is None:
+            self.add(key, sig)
+        return match
+
+    def save(self, path):
+        """Write the index to path (.npz) atomically"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        live = [row for row, key in enumerate(self.keys) if key is not None]
+        sigs = np.stack([self.sigs[r] for r in live]) if live else np.zeros((0, self.num_perm), dtype=np.uint32)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, keys=np.array([self.keys[r] for r in live], dtype=str), sigs=sigs,
+                     params=np.array([self.threshold, self.num_perm, self.seed]))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, threshold=None):
+        """Index saved at path; signatures don't depend on threshold, so it may be changed here"""
+        with np.load(path) as z:
+            saved, num_perm, seed = z["params"].tolist()
+            index = cls(saved if threshold is None else threshold, int(num_perm), int(seed))
+            for key, sig in zip(z["keys"].tolist(), z["sigs"]):
+                index.add(key, sig)
+        return index
+
+    @classmethod
+    def open(cls, path=None, threshold=None, num_perm=128, seed=1):
+        """Load the index at path if it exists, else start an empty one.
+
+        threshold=None keeps a loaded index's own threshold (DEFAULT_THRESHOLD for a new one).
+        """
+        if path and os.path.exists(path):
+            return cls.load(path, threshold)
+        return cls(DEFAULT_THRESHOLD if threshold is None else threshold, num_perm, seed)
@@ -1,33 +1,97 @@
+import sys, os
+# Add parent directory to path so we can import scripts.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 import json, argparse, pathlib
 
+MIN_BODY_CHARS = 60
+
 def clean(text: str) -> str:
     """Remove carriage returns and normalize whitespace"""
     text = text.replace("\r", "")
     text = " ".join(text.split())
     return text.strip()
 
-p = argparse.ArgumentParser()
-p.add_argument("--inputs", nargs="+", required=True)
-p.add_argument("--out_jsonl", default="data/interim/all_posts.jsonl")
-args = p.parse_args()
-
-pathlib.Path(args.out_jsonl).parent.mkdir(parents=True, exist_ok=True)
-
-seen = set()
-with open(args.out_jsonl, "w", encoding="utf-8") as out:
-    for fp in args.inputs:
-        for line in open(fp, "r", encoding="utf-8"):
-            d = json.loads(line)
-            key = (d.get("source"), d.get("id"))
-            if key in seen:
-                continue
-            seen.add(key)
-            body = clean(d.get("body", ""))
-            title = clean(d.get("title", ""))
-            if not body or len(body) < 60:
-                continue
-            d["body"] = body
-            d["title"] = title
-            out.write(json.dumps(d, ensure_ascii=False) + "\n")
-
-print("Wrote", args.out_jsonl)
+def record_key(d: dict):
+    """Identity of a raw post for de-duplication"""
+    return (d.get("source"), d.get("id"))
+
+def record_ref(key) -> str:
+    """'source:id' string form of a record key"""
+    source, rid = key
+    return f"{source}:{rid}"
+
+def mark_near_dup(d: dict, match):
+    """Annotate a post flagged as a near-duplicate of match=(ref, jaccard)"""
+    d["near_dup_of"], d["near_dup_jaccard"] = match[0], round(match[1], 3)
+    return d
+
+def add_near_dup_args(p):
+    p.add_argument("--near_dup_threshold", type=float, default=None,
+                   help="MinHash Jaccard at which a body counts as a near-duplicate of an earlier one")
+    p.add_argument("--near_dup_index", default=None,
+                   help=".npz MinHash index to compare against and extend (enables near-dup detection)")
+    p.add_argument("--near_dup_action", choices=["drop", "flag"], default="drop",
+                   help="drop near-duplicates, or keep them with near_dup_of/near_dup_jaccard set")
+
+def open_near_dup_index(args):
+    """NearDupIndex for the CLI flags, or None if near-dup detection is off"""
+    if args.near_dup_threshold is None and args.near_dup_index is None:
+        return None
+    from scripts.near_dup import NearDupIndex
+    index = NearDupIndex.open(args.near_dup_index, args.near_dup_threshold)
+    print(f"Near-dup index: {len(index)} posts, threshold {index.threshold}, "
+          f"{index.bands} bands x {index.rows} rows")
+    return index
+
+def normalize_record(d: dict):
+    """Cleaned copy of a raw post, or None if its body is too short to keep"""
+    body = clean(d.get("body", ""))
+    title = clean(d.get("title", ""))
+    if not body or len(body) < MIN_BODY_CHARS:
+        return None
+    d = dict(d)
+    d["body"] = body
+    d["title"] = title
+    return d
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--inputs", nargs="+", required=True)
+    p.add_argument("--out_jsonl", default="data/interim/all_posts.jsonl")
+    add_near_dup_args(p)
+    args = p.parse_args()
+    near_dups = open_near_dup_index(args)
+    n_near = 0
+
+    pathlib.Path(args.out_jsonl).parent.mkdir(parents=True, exist_ok=True)
+
+    seen = set()
+    with open(args.out_jsonl, "w", encoding="utf-8") as out:
+        for fp in args.inputs:
+            for line in open(fp, "r", encoding="utf-8"):
+                d = json.loads(line)
+                key = record_key(d)
+                if key in seen:
+                    continue
+                seen.add(key)
+                d = normalize_record(d)
+                if d is None:
+                    continue
+                if near_dups is not None:
+                    match = near_dups.check(record_ref(key), near_dups.signature(d["body"]))
+                    if match is not None:
+                        n_near += 1
+                        if args.near_dup_action == "drop":
+                            continue
+                        mark_near_dup(d, match)
+                out.write(json.dumps(d, ensure_ascii=False) + "\n")
+
+    if near_dups is not None:
+        print(f"Near-duplicates {'dropped' if args.near_dup_action == 'drop' else 'flagged'}: {n_near}")
+        if args.near_dup_index:
+            near_dups.save(args.near_dup_index)
+    print("Wrote", args.out_jsonl)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import sys, os
+# Add parent directory to path so we can import scripts.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse, hashlib, json, pathlib, sqlite3, tempfile, time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from scripts.normalize_posts import (
+    normalize_record, record_key, record_ref, mark_near_dup, add_near_dup_args, open_near_dup_index,
+)
+from scripts.near_dup import minhash_signature
+from scripts.manifest import Manifest, content_hash, processing_fingerprint
+from scripts.build_sft_pairs import build_pair
+
+def split_bucket(key: str, seed: int = 42) -> float:
+    """Stable position in [0, 1) for a record key: the same post lands in the same split on every run"""
+    h = hashlib.blake2b(f"{seed}:{key}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(h, "big") / 2**64
+
+class SeenSet:
+    """Record keys already emitted, kept in sqlite so memory stays flat however large the input"""
+    def __init__(self, path=None):
+        self._tmp = None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="pipeline-seen-", suffix=".sqlite")
+            os.close(fd)
+            self._tmp = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def add(self, key: str) -> bool:
+        """Insert key; True if it was not seen before"""
+        return self.db.execute("INSERT OR IGNORE INTO seen VALUES (?)", (key,)).rowcount == 1
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        if self._tmp:
+            os.remove(self._tmp)
+
+def process_chunk(lines, ratio=0.9, seed=42, perms=None, fingerprint=None):
+    """CPU-bound stages for a chunk of raw JSONL lines: normalise, classify/build pair,
+    assign split and, given MinHash perms=(a, b), compute the body signature.
+
+    Returns one (dedup key, content hash, kind, post line, pair line, split, signature)
+    tuple per line, in order, already serialised so the parent only writes; the hash is
+    None without a manifest fingerprint, and everything after it is None for posts
+    dropped by normalisation. De-duplication happens in the parent so that the first
+    occurrence wins exactly as in normalize_posts.py.
+    """
+    out = []
+    for line in lines:
+        d = json.loads(line)
+        key = record_key(d)
+        h = content_hash(line, fingerprint) if fingerprint else None
+        post = normalize_record(d)
+        if post is None:
+            out.append((json.dumps(key), h, None, None, None, None, None))
+            continue
+        pair = build_pair(post)
+        split = "train" if split_bucket(record_ref(key), seed) < ratio else "val"
+        sig = minhash_signature(post["body"], *perms) if perms else None
+        out.append((json.dumps(key), h, pair["meta"]["type"],
+                    json.dumps(post, ensure_ascii=False) + "\n",
+                    json.dumps(pair, ensure_ascii=False) + "\n", split, sig))
+    return out
+
+def read_chunks(paths, size, skip=None):
+    """Chunks of non-blank lines from paths, leaving out lines for which skip(line) is true"""
+    chunk = []
+    for fp in paths:
+        for line in open(fp, "r", encoding="utf-8"):
+            if not line.strip() or (skip and skip(line)):
+                continue
+            chunk.append(line)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def ordered_results(pool, fn, chunks, max_pending):
+    """Map fn over chunks in a pool, in order, with at most max_pending chunks in flight"""
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.submit(fn, chunk))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def open_outputs(args, suffix=""):
+    """Output files by name ('interim', 'all', 'train', 'val'); None where the path is ''"""
+    outs = {}
+    for name, path in [("interim", args.interim_out), ("all", args.all_out),
+                       ("train", args.train_out), ("val", args.val_out)]:
+        if path:
+            pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+            outs[name] = open(path + suffix, "w", encoding="utf-8")
+        else:
+            outs[name] = None
+    return outs
+
+def write_record(outs, counts, kinds, kind, post, pair, split):
+    kinds[kind] += 1
+    counts[split] += 1
+    for name, text in (("interim", post), ("all", pair), (split, pair)):
+        if outs[name]:
+            outs[name].write(text)
+
+def export_manifest(manifest, args, counts, kinds):
+    """Rewrite every output from the manifest's kept records, replacing the files atomically"""
+    outs = open_outputs(args, ".tmp")
+    for kind, post, pair, split in manifest.kept():
+        write_record(outs, counts, kinds, kind, post, pair, split)
+    for f in outs.values():
+        if f:
+            f.close()
+            os.replace(f.name, f.name[:-len(".tmp")])
+
+def main():
+    p = argparse.ArgumentParser(description="Stream raw posts through normalise -> build pairs -> split")
+    p.add_argument("--inputs", nargs="+", required=True)
+    p.add_argument("--interim_out", default="data/interim/all_posts.jsonl", help="normalised posts ('' to skip)")
+    p.add_argument("--all_out", default="data/processed/sft_all.jsonl", help="all pairs ('' to skip)")
+    p.add_argument("--train_out", default="data/processed/sft_train.jsonl")
+    p.add_argument("--val_out", default="data/processed/sft_val.jsonl")
+    p.add_argument("--ratio", type=float, default=0.9)
+    p.add_argument("--seed", type=int, default=42, help="salt for the hash split")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--chunk_size", type=int, default=500, help="lines per worker task")
+    p.add_argument("--seen_db", default=None, help="sqlite file for the dedup set (default: temporary)")
+    p.add_argument("--manifest", default=None,
+                   help="sqlite manifest for incremental runs: unchanged records are skipped, "
+                        "outputs are rebuilt from it (replaces --seen_db)")
+    add_near_dup_args(p)
+    args = p.parse_args()
+    near_dups = open_near_dup_index(args)
+
+    counts, kinds = Counter(), Counter()
+    if args.manifest:
+        # Incremental: records whose content hash is known were processed by an earlier run
+        manifest, seen, outs = Manifest(args.manifest), None, None
+        run = manifest.begin_run(args.inputs)
+        fingerprint = processing_fingerprint(args.ratio, args.seed, args.near_dup_action,
+                                             near_dups.threshold if near_dups is not None else None)
+
+        def skip(line):
+            if manifest.known_hash(content_hash(line, fingerprint)):
+                counts["unchanged"] += 1
+                return True
+            return False
+    else:
+        manifest, seen, outs = None, SeenSet(args.seen_db), open_outputs(args)
+        fingerprint = skip = None
+
+    fn = partial(process_chunk, ratio=args.ratio, seed=args.seed, fingerprint=fingerprint,
+                 perms=(near_dups.a, near_dups.b) if near_dups is not None else None)
+    chunks = read_chunks(args.inputs, args.chunk_size, skip)
+
+    t0 = time.time()
+    pool = ProcessPoolExecutor(args.workers) if args.workers > 1 else None
+    try:
+        results = ordered_results(pool, fn, chunks, 2 * args.workers) if pool else map(fn, chunks)
+        for rows in results:
+            for key, h, kind, post, pair, split, sig in rows:
+                counts["read"] += 1
+                if manifest:
+                    manifest.add_hash(h)
+                    last = manifest.last_run(key)
+                    if last == run:
+                        counts["duplicate"] += 1
+                        continue
+                    counts["new" if last is None else "changed"] += 1
+                elif not seen.add(key):
+                    counts["duplicate"] += 1
+                    continue
+                status = "kept"
+                if post is None:
+                    counts["too_short"] += 1
+                    status = "short"
+                elif near_dups is not None:
+                    match = near_dups.check(record_ref(json.loads(key)), sig)
+                    if match is not None:
+                        counts["near_dup"] += 1
+                        if args.near_dup_action == "drop":
+                            status = "near_dup"
+                        else:
+                            post = json.dumps(mark_near_dup(json.loads(post), match), ensure_ascii=False) + "\n"
+                            pair = json.loads(pair)
+                            pair["meta"]["near_dup_of"] = match[0]
+                            pair = json.dumps(pair, ensure_ascii=False) + "\n"
+                if manifest:
+                    manifest.put(key, run, h, status, kind, split, post, pair)
+                elif status == "kept":
+                    write_record(outs, counts, kinds, kind, post, pair, split)
+            if manifest:
+                manifest.commit()
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        if seen:
+            seen.close()
+        for f in (outs or {}).values():
+            if f:
+                f.close()
+    if near_dups is not None and args.near_dup_index:
+        near_dups.save(args.near_dup_index)
+    if manifest:
+        export_manifest(manifest, args, counts, kinds)
+        manifest.end_run(run, dict(counts))
+        manifest.close()
+    elapsed = time.time() - t0
+
+    if manifest:
+        print(f"Incremental run {run}: {counts['new']} new, {counts['changed']} changed, "
+              f"{counts['unchanged']} unchanged (skipped)")
+    print(f"Read {counts['read']} posts: {counts['duplicate']} duplicates, {counts['too_short']} too short, "
+          f"{counts['near_dup']} near-duplicates ({args.near_dup_action if near_dups is not None else 'off'})")
+    print(f"Train: {counts['train']} examples -> {args.train_out}")
+    print(f"Val: {counts['val']} examples -> {args.val_out}")
+    print("Types:", dict(kinds))
+    print(f"{(counts['read'] + counts['unchanged']) / max(elapsed, 1e-9):,.0f} posts/sec "
+          f"({elapsed:.1f}s, {args.workers} workers)")
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,25 @@
-import os, torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+import os, sys
+
+# Add parent directory to path so we can import serve.loading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serve.loading import load_model, load_tokenizer
 
 BASE = os.getenv("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
 ADAPTER = os.getenv("OUT_DIR", "artifacts/sft")
+MERGED = os.getenv("MERGED_DIR", "artifacts/merged")
 
 print("="*60)
 print("LOADING MODEL...")
 print("="*60)
 
 # Load tokenizer
-tok = AutoTokenizer.from_pretrained(BASE, use_fast=True)
-tok.pad_token = tok.eos_token
-
-# Load base model
-base = AutoModelForCausalLM.from_pretrained(
-    BASE, 
-    torch_dtype=torch.float32, 
-    device_map="cpu"
-)
+tok = load_tokenizer(BASE)
 
-# Load your trained adapter
-model = PeftModel.from_pretrained(base, ADAPTER)
+# Load the merged checkpoint if exported, else base + adapter
+model, weights = load_model(BASE, ADAPTER, MERGED)
 
-print("✅ Model loaded with your trained adapter!")
+print(f"✅ Model loaded with your trained adapter! ({weights})")
 
 print("\n" + "="*60)
 print("TEST PROMPT:")
@@ -0,0 +1,110 @@
+import os, threading
+from collections import OrderedDict
+
+from serve.response_cache import weights_fingerprint
+
+DEFAULT_ADAPTER = "default"
+
+
+def parse_adapter_specs(spec):
+    """ADAPTERS env value "name=path,name2=path2" -> {name: path}"""
+    adapters = {}
+    for item in filter(None, (x.strip() for x in (spec or "").split(","))):
+        name, _, path = item.partition("=")
+        if not path:
+            raise ValueError(f"Bad ADAPTERS entry {item!r}; expected name=path")
+        adapters[name.strip()] = path.strip()
+    return adapters
+
+
+class UnknownAdapter(LookupError):
+    """The adapter isn't registered (or was unregistered while a request for it waited)"""
+
+    def __init__(self, name):
+        super().__init__(f"Unknown adapter: {name}")
+        self.name = name
+
+
+class AdapterRegistry:
+    """Named LoRA adapters on one shared PeftModel base.
+
+    Registered adapters are loaded on demand and at most `max_resident` stay
+    in memory; the least recently used one is unloaded first (the default
+    adapter is never evicted, so `max_resident` must leave room for one more). Rows select their adapter per call through
+    peft's `adapter_names`, so one batch can serve several adapters. Loading
+    and unloading must happen on the model thread.
+    """
+
+    def __init__(self, model, default_path, max_resident=4):
+        if max_resident < 2:
+            raise ValueError(f"max_resident must be at least 2 (the default adapter plus one), got {max_resident}")
+        self.model = model
+        self.max_resident = max_resident
+        self._lock = threading.Lock()
+        self._paths = {DEFAULT_ADAPTER: default_path}
+        self._fingerprints = {DEFAULT_ADAPTER: weights_fingerprint(default_path)}
+        self._versions = {DEFAULT_ADAPTER: 0}
+        self._resident = OrderedDict([(DEFAULT_ADAPTER, True)])
+
+    def register(self, name, path):
+        """Make an adapter selectable; it is loaded the first time it is used"""
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Adapter directory not found: {path}")
+        with self._lock:
+            if name in self._resident:
+                # Re-registering replaces the weights
+                self._unload(name)
+            self._paths[name] = path
+            self._fingerprints[name] = weights_fingerprint(path)
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def unregister(self, name):
+        if name == DEFAULT_ADAPTER:
+            raise ValueError("The default adapter can't be removed")
+        with self._lock:
+            if name not in self._paths:
+                raise UnknownAdapter(name)
+            if name in self._resident:
+                self._unload(name)
+            del self._paths[name]
+            del self._fingerprints[name]
+
+    def acquire(self, name):
+        """Resolve a request's adapter to a resident peft adapter name, loading it if needed"""
+        name = name or DEFAULT_ADAPTER
+        with self._lock:
+            if name not in self._paths:
+                raise UnknownAdapter(name)
+            if name not in self._resident:
+                while len(self._resident) >= self.max_resident:
+                    victim = next((n for n in self._resident if n != DEFAULT_ADAPTER), None)
+                    if victim is None:
+                        break
+                    self._unload(victim)
+                self.model.load_adapter(self._paths[name], adapter_name=name, is_trainable=False)
+                self._resident[name] = True
+            self._resident.move_to_end(name)
+            return name
+
+    def _unload(self, name):
+        self.model.delete_adapter(name)
+        self._resident.pop(name, None)
+
+    def known(self, name):
+        return (name or DEFAULT_ADAPTER) in self._paths
+
+    def fingerprint(self, name):
+        """Weights identity for response-cache keys"""
+        return self._fingerprints[name or DEFAULT_ADAPTER]
+
+    def cache_key(self, name):
+        """Prefix-cache key; changes whenever the adapter's weights are replaced"""
+        name = name or DEFAULT_ADAPTER
+        return (name, self._versions[name])
+
+    def list(self):
+        with self._lock:
+            return [
+                {"name": n, "path": p, "resident": n in self._resident, "fingerprint": self._fingerprints[n]}
+                for n, p in self._paths.items()
+            ]
@@ -0,0 +1,41 @@
+"""Admission control: the requests the server turns away rather than queueing.
+
+The scheduler queue is bounded and every job may carry a deadline. A full
+queue is refused straight away with 429; a job that can't start, or doesn't
+finish, before its deadline fails with 503. Both tell the client when to
+retry, so bursts are shed at the door instead of stretching everyone's
+latency. Kept free of torch so the app can map them to responses before the
+model has loaded.
+"""
+import math
+
+
+class Rejected(RuntimeError):
+    """A job the server won't run (or finish); `status` is the HTTP status to answer with"""
+    status = 503
+    reason = "rejected"
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def headers(self):
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class QueueFull(Rejected):
+    """Too many requests are already waiting for the model"""
+    status = 429
+    reason = "queue_full"
+
+
+class DeadlineExceeded(Rejected):
+    """The request can't start, or didn't finish, before its deadline"""
+    status = 503
+    reason = "deadline"
+
+
+class ClientGone(Rejected):
+    """The caller disconnected; nobody will read the answer"""
+    status = 499
+    reason = "disconnected"
@@ -1,95 +1,490 @@
-import os, torch
-from fastapi import FastAPI
-from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+import os, sys, time, hmac, asyncio, threading, traceback
+
+# Add parent directory to path so `python serve/app.py` can import serve.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from serve.adapters import DEFAULT_ADAPTER, UnknownAdapter, parse_adapter_specs
+from serve.admission import Rejected
+from serve.response_cache import is_deterministic, request_key
+from serve.telemetry import CONTENT_TYPE as METRICS_CONTENT_TYPE, process_rss_bytes, telemetry
 
 # Configuration
 BASE = os.getenv("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
 ADAPTER = os.getenv("OUT_DIR", "artifacts/sft")
+MERGED = os.getenv("MERGED_DIR", "artifacts/merged")
+QUANTIZE = os.getenv("QUANTIZE", "")
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "15"))
+# Admission control: requests beyond this many queued get 429; 0 = unbounded
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "64"))
+# Default (and maximum) per-request deadline in seconds; 0 = none
+REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "120"))
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", "8"))
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")
+ADAPTERS = parse_adapter_specs(os.getenv("ADAPTERS", ""))
+ADAPTER_MAX_RESIDENT = int(os.getenv("ADAPTER_MAX_RESIDENT", "4"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Structure stopping for requests that don't set `kind` (opt-in: it changes the returned text)
+STRUCTURE_STOP = os.getenv("STRUCTURE_STOP", "0") == "1"
+SPECULATIVE = os.getenv("SPECULATIVE", "")
+PROMPT_LOOKUP_TOKENS = int(os.getenv("PROMPT_LOOKUP_TOKENS", "10"))
+PROMPT_LOOKUP_NGRAM = int(os.getenv("PROMPT_LOOKUP_NGRAM", "2"))
+DRAFT_MODEL = os.getenv("DRAFT_MODEL", "")
+DRAFT_TOKENS = int(os.getenv("DRAFT_TOKENS", "5"))
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+# Seconds clients are told to wait (Retry-After) while the model is still loading
+LOADING_RETRY_AFTER = os.getenv("LOADING_RETRY_AFTER", "5")
+# How often a waiting /generate checks whether its client has gone
+DISCONNECT_POLL_S = 0.25
+
+
+class ServingState:
+    """The model and everything built around it, loaded once per process.
+
+    `status` moves from "starting" to "loading" to "ready" (or "failed").
+    torch/transformers are only imported by `load`, so importing this module
+    and answering health checks doesn't wait for them.
+    """
+
+    def __init__(self):
+        self.status = "starting"
+        self.error = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def start(self):
+        """Begin loading in a background thread (no-op if loading has already begun)"""
+        with self._lock:
+            if self.status != "starting":
+                return
+            self.status = "loading"
+        threading.Thread(target=self._load, name="model-loader", daemon=True).start()
+
+    def load(self):
+        """Load in the calling thread; raises if loading fails"""
+        with self._lock:
+            if self.status == "ready":
+                return self
+            self.status = "loading"
+        self._load()
+        if self.status == "failed":
+            raise RuntimeError(f"Model loading failed: {self.error}")
+        return self
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            self._build()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = f"{type(e).__name__}: {e}"
+            self.status = "failed"
+            return
+        self.load_seconds = time.perf_counter() - started
+        self.status = "ready"
+        print(f"✅ Model loaded and ready! ({self.load_seconds:.1f}s)")
+        print("="*60)
+
+    def _build(self):
+        from serve.adapters import AdapterRegistry
+        from serve.batching import BatchScheduler, generate_batch
+        from serve.loading import load_model, load_tokenizer, quantize_model
+        from serve.prefix_cache import PrefixKVCache, known_prefixes
+        from serve.response_cache import ResponseCache, weights_fingerprint
+        from serve.speculative import speculative_kwargs
+
+        print("="*60)
+        print("LOADING MODEL FOR API...")
+        print("="*60)
+
+        # Load tokenizer
+        tok = load_tokenizer(BASE)
+
+        # Load the merged checkpoint (memory-mapped) if exported, else base + adapter
+        model, weights = load_model(BASE, ADAPTER, MERGED)
+        print(f"Weights: {MERGED if weights == 'merged' else ADAPTER} ({weights})")
 
-print("="*60)
-print("LOADING MODEL FOR API...")
-print("="*60)
+        # Optional dynamic int8 quantisation of the Linear layers (adapter merged first)
+        model = quantize_model(model, QUANTIZE)
+        if QUANTIZE:
+            print(f"Quantized: {QUANTIZE}")
 
-# Load tokenizer
-tok = AutoTokenizer.from_pretrained(BASE, use_fast=True)
-tok.pad_token = tok.eos_token
+        # Named adapters on the shared base (needs the unmerged, unquantised model)
+        adapters = None
+        if weights == "adapter" and not QUANTIZE:
+            adapters = AdapterRegistry(model, ADAPTER, max_resident=ADAPTER_MAX_RESIDENT)
+            for name, path in ADAPTERS.items():
+                adapters.register(name, path)
+            if ADAPTERS:
+                print(f"Adapters: {', '.join([DEFAULT_ADAPTER, *ADAPTERS])}")
 
-# Load base model
-base = AutoModelForCausalLM.from_pretrained(
-    BASE, 
-    torch_dtype=torch.float32, 
-    device_map="cpu"
-)
+        # Optional speculative decoding for single-row generation: drafts from the prompt
+        # (outputs copy numbers and names out of <CONTEXT>) or from a small draft model
+        speculative = speculative_kwargs(SPECULATIVE, tok, PROMPT_LOOKUP_TOKENS, PROMPT_LOOKUP_NGRAM,
+                                         DRAFT_MODEL, DRAFT_TOKENS)
+        if speculative:
+            print(f"Speculative decoding: {SPECULATIVE}" + (f" ({DRAFT_MODEL})" if SPECULATIVE == "draft" else ""))
 
-# Load your trained adapter
-model = PeftModel.from_pretrained(base, ADAPTER)
+        # Keys/values for the shared WSLAnalytics preamble are computed once and reused
+        prefix_cache = PrefixKVCache(tok, known_prefixes(), capacity=PREFIX_CACHE_SIZE)
 
-print("✅ Model loaded and ready!")
-print("="*60)
+        # All generation goes through one scheduler that batches concurrent requests
+        scheduler = BatchScheduler(
+            lambda jobs: generate_batch(model, tok, jobs, prefix_cache, adapters, speculative),
+            max_batch_size=BATCH_MAX_SIZE,
+            window_ms=BATCH_WINDOW_MS,
+            max_queue=QUEUE_MAX_SIZE,
+        )
 
-# Create FastAPI app
-app = FastAPI(title="WSLAnalytics API", version="1.0")
+        # Opt-in cache of deterministic responses (greedy or caller-seeded)
+        self.response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_DB) if RESPONSE_CACHE else None
+        self.weights_id = weights_fingerprint(BASE, MERGED if weights == "merged" else ADAPTER, QUANTIZE or "fp32")
+        self.tok, self.model, self.weights, self.adapters = tok, model, weights, adapters
+        self.speculative, self.prefix_cache, self.scheduler = speculative, prefix_cache, scheduler
+
+    def check_adapter(self, name):
+        """Reject requests for adapters this server can't serve"""
+        if self.adapters is None:
+            if name not in (None, DEFAULT_ADAPTER):
+                raise HTTPException(409, "Adapter selection needs the unmerged, unquantised base + adapter")
+        elif not self.adapters.known(name):
+            raise HTTPException(404, f"Unknown adapter: {name}")
+
+    def adapter_id(self, name):
+        """Identity of the weights serving a request, for response-cache keys"""
+        if self.adapters is None:
+            return self.weights_id
+        return f"{BASE}|{self.adapters.fingerprint(name)}"
+
+
+async def ready_state(request: Request) -> ServingState:
+    """The app's ServingState, or 503 (with Retry-After) until the model has loaded"""
+    state = request.app.state.serving
+    if not state.ready:
+        detail = f"Model {state.status}" + (f": {state.error}" if state.error else "")
+        raise HTTPException(503, detail, headers={"Retry-After": LOADING_RETRY_AFTER})
+    return state
+
+
+router = APIRouter()
 
 # Request schema
 class GenerateRequest(BaseModel):
     prompt: str
-    max_tokens: int = 220
-    temperature: float = 0.3
-    top_p: float = 0.9
+    # Bounds are checked here (422) so one bad request can't fail the batch it would join
+    max_tokens: int = Field(220, ge=1)
+    temperature: float = Field(0.3, ge=0)  # 0 decodes greedily
+    top_p: float = Field(0.9, gt=0, le=1)
+    seed: Optional[int] = None  # fixes sampling so the response is repeatable
+    adapter: Optional[str] = None  # registered adapter name; None = default
+    response_format: Optional[Literal["json"]] = None  # "json": output is constrained to one JSON object/array
+    stop: Optional[List[str]] = None  # stop (and cut the text) at the first of these strings
+    # Stop once the house-style structure is complete; "auto" reads the kind from the prompt's TASK line.
+    # Unset follows STRUCTURE_STOP ("auto" when it is 1, else no structure stopping)
+    kind: Optional[Literal["auto", "none", "preview", "recap", "thread", "caption"]] = None
+    timeout_s: Optional[float] = Field(None, gt=0)  # give up (503) if not done in time; capped at REQUEST_TIMEOUT_S
+
+class AdapterSpec(BaseModel):
+    name: str
+    path: str
+
+def job_kind(req):
+    """Content kind whose structure ends generation early, if structure stopping applies"""
+    from serve.stopping import resolve_kind
+    kind = req.kind if req.kind is not None else ("auto" if STRUCTURE_STOP else "none")
+    return resolve_kind(kind, req.prompt)
+
+def job_deadline(req):
+    """time.monotonic() deadline from the request's timeout and the server's cap, if any"""
+    limits = [t for t in (req.timeout_s, REQUEST_TIMEOUT_S) if t and t > 0]
+    return time.monotonic() + min(limits) if limits else None
+
+def make_job(req):
+    from serve.batching import GenerationJob
+    return GenerationJob(
+        prompt=req.prompt,
+        max_tokens=req.max_tokens,
+        temperature=req.temperature,
+        top_p=req.top_p,
+        seed=req.seed,
+        adapter=None if req.adapter == DEFAULT_ADAPTER else req.adapter,
+        response_format=req.response_format,
+        stop=req.stop,
+        kind=job_kind(req),
+        deadline=job_deadline(req)
+    )
+
+async def wait_for_job(request, job, fut):
+    """Await a scheduled job's result, cancelling the job if the client disconnects first"""
+    waiter = asyncio.wrap_future(fut)
+    while True:
+        done, _ = await asyncio.wait({waiter}, timeout=DISCONNECT_POLL_S)
+        if done:
+            return waiter.result()
+        if await request.is_disconnected():
+            job.cancelled.set()
+            waiter.cancel()
+            telemetry.count_rejected("disconnected")
+            raise HTTPException(499, "Client closed request")
+
+def check_admin(token):
+    # Loading an adapter can unpickle arbitrary files, so no token means no admin API
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, "Admin endpoints are disabled; set ADMIN_TOKEN to enable them")
+    if token is None or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(403, "Invalid admin token")
 
-# Health check endpoint
-@app.get("/")
-def root():
+# Health check endpoints
+@router.get("/")
+def root(request: Request):
     return {
         "service": "WSLAnalytics API",
         "status": "running",
+        "model_status": request.app.state.serving.status,
         "model": BASE,
         "adapter": ADAPTER
     }
 
+@router.get("/healthz")
+def healthz(request: Request):
+    """Liveness: the process is serving; fails only if the model can never load (restart it)"""
+    state = request.app.state.serving
+    if state.status == "failed":
+        return JSONResponse({"status": "failed", "error": state.error}, status_code=500)
+    return {"status": "ok"}
+
+@router.get("/readyz")
+def readyz(request: Request):
+    """Readiness: 200 once the model is loaded and requests can be served, 503 before"""
+    state = request.app.state.serving
+    if not state.ready:
+        return JSONResponse({"status": state.status, "error": state.error}, status_code=503,
+                            headers={"Retry-After": LOADING_RETRY_AFTER})
+    return {"status": "ready", "load_seconds": round(state.load_seconds, 2)}
+
 # Generation endpoint
-@app.post("/generate")
-def generate(req: GenerateRequest):
+@router.post("/generate")
+async def generate(req: GenerateRequest, request: Request, state: ServingState = Depends(ready_state)):
     """Generate text from your fine-tuned model"""
+    started = time.perf_counter()
+    state.check_adapter(req.adapter)
+    response_cache = state.response_cache
     
-    # Tokenize input
-    ids = tok(req.prompt, return_tensors="pt")
+    # Deterministic requests can be answered from the response cache
+    key = None
+    if response_cache is not None and is_deterministic(req.temperature, req.seed):
+        key = request_key(req.prompt, req.max_tokens, req.temperature, req.top_p, req.seed,
+                          state.adapter_id(req.adapter), req.response_format, req.stop, job_kind(req))
+        cached = response_cache.get(key)
+        if cached is not None:
+            telemetry.observe_request("generate", time.perf_counter() - started, cached=True)
+            return {**cached, "cached": True}
     
-    # Generate
-    output = model.generate(
-        **ids,
-        max_new_tokens=req.max_tokens,
-        do_sample=True,
-        temperature=req.temperature,
-        top_p=req.top_p
-    )
+    # Queue the request; the scheduler batches it with any concurrent callers
+    # (or refuses it when the queue is full or it can't meet its deadline)
+    job = make_job(req)
+    result = await wait_for_job(request, job, state.scheduler.submit(job))
+    generated = result["text"]
     
-    # Decode
-    text = tok.decode(output[0], skip_special_tokens=True)
-    
-    # Extract just generated part (after prompt)
-    generated = text[len(req.prompt):].strip()
-    
-    return {
+    response = {
         "text": generated,
         "prompt_length": len(req.prompt),
-        "generated_length": len(generated)
+        "generated_length": len(generated),
+        "generated_tokens": result["generated_tokens"]
     }
+    if key is not None:
+        response_cache.put(key, response)
+    telemetry.observe_request("generate", time.perf_counter() - started)
+    return {**response, "cached": False}
+
+# Streaming endpoint
+@router.post("/generate/stream")
+async def generate_stream(req: GenerateRequest, state: ServingState = Depends(ready_state)):
+    """Stream tokens as server-sent events, ending with a latency summary event"""
+    from serve.streaming import TimedTextStreamer, latency_summary, sse, stream_generate
+
+    started = time.perf_counter()
+    state.check_adapter(req.adapter)
+    job = make_job(req)
+    streamer = TimedTextStreamer(state.tok)
+    
+    # Runs on the model thread between batches so it never competes with /generate
+    done = state.scheduler.run_exclusive(lambda: stream_generate(
+        state.model, state.tok, job, streamer, state.prefix_cache, state.adapters, state.speculative))
+    
+    async def events():
+        text, finished = [], False
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, streamer, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    text.append(chunk)
+                    yield sse({"text": chunk})
+            try:
+                trimmed = await asyncio.wrap_future(done)
+            except Exception as e:
+                finished = True
+                if isinstance(e, Rejected):
+                    telemetry.count_rejected(e.reason)
+                yield sse({"error": str(e)}, event="error")
+                return
+            finished = True
+            summary = latency_summary(started, streamer.token_times)
+            summary["text"] = trimmed if trimmed is not None else "".join(text).strip()
+            summary["generated_length"] = len(summary["text"])
+            telemetry.observe_request("generate_stream", time.perf_counter() - started)
+            yield sse(summary, event="summary")
+        finally:
+            if not finished:
+                # The client went away mid-stream: stop generating for it
+                job.cancelled.set()
+                if done.cancel():
+                    # Still queued, so stream_generate will never run and end the stream;
+                    # end it here or the thread reading the streamer blocks forever
+                    streamer.end()
+                telemetry.count_rejected("disconnected")
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# Adapter registry
+@router.get("/adapters")
+def list_adapters(state: ServingState = Depends(ready_state)):
+    """Registered adapters and which are resident"""
+    adapters = state.adapters
+    if adapters is None:
+        return {"enabled": False, "adapters": []}
+    return {"enabled": True, "max_resident": adapters.max_resident, "adapters": adapters.list()}
+
+@router.post("/admin/adapters")
+async def load_adapter(spec: AdapterSpec, x_admin_token: Optional[str] = Header(None),
+                       state: ServingState = Depends(ready_state)):
+    """Register (or replace) a named adapter and load it without restarting"""
+    check_admin(x_admin_token)
+    adapters = state.adapters
+    if adapters is None:
+        raise HTTPException(409, "Adapter hot-swap needs the unmerged, unquantised base + adapter")
+    if spec.name == DEFAULT_ADAPTER:
+        raise HTTPException(400, "The default adapter is fixed at startup")
+    
+    def load():
+        adapters.register(spec.name, spec.path)
+        adapters.acquire(spec.name)
+    
+    # Runs on the model thread, between batches
+    try:
+        await asyncio.wrap_future(state.scheduler.run_exclusive(load))
+    except FileNotFoundError as e:
+        raise HTTPException(404, str(e))
+    return {"loaded": spec.name, "adapters": adapters.list()}
+
+@router.delete("/admin/adapters/{name}")
+async def unload_adapter(name: str, x_admin_token: Optional[str] = Header(None),
+                         state: ServingState = Depends(ready_state)):
+    """Unload and forget a named adapter"""
+    check_admin(x_admin_token)
+    adapters = state.adapters
+    if adapters is None:
+        raise HTTPException(409, "Adapter hot-swap needs the unmerged, unquantised base + adapter")
+    if name == DEFAULT_ADAPTER:
+        raise HTTPException(400, "The default adapter can't be removed")
+    if not adapters.known(name):
+        raise HTTPException(404, f"Unknown adapter: {name}")
+    await asyncio.wrap_future(state.scheduler.run_exclusive(lambda: adapters.unregister(name)))
+    return {"unloaded": name, "adapters": adapters.list()}
+
+# Response cache statistics
+@router.get("/cache/stats")
+def cache_stats(state: ServingState = Depends(ready_state)):
+    """Hit/miss counters for the response cache"""
+    if state.response_cache is None:
+        return {"enabled": False}
+    return state.response_cache.stats()
+
+# Prometheus metrics
+@router.get("/metrics")
+def metrics():
+    """Stage latency histograms, token counters, throughput and RSS in the Prometheus text format"""
+    return Response(telemetry.render(), media_type=METRICS_CONTENT_TYPE)
 
 # Model info endpoint
-@app.get("/model-info")
-def model_info():
+@router.get("/model-info")
+def model_info(state: ServingState = Depends(ready_state)):
     """Get information about the loaded model"""
+    from serve.loading import model_memory_bytes
+
+    model, adapters = state.model, state.adapters
     return {
         "base_model": BASE,
         "adapter_path": ADAPTER,
-        "vocab_size": len(tok),
+        "weights": state.weights,
+        "merged_path": MERGED if state.weights == "merged" else None,
+        "vocab_size": len(state.tok),
         "total_parameters": model.num_parameters(),
-        "device": "cpu"
+        "quantize": QUANTIZE or "fp32",
+        "weights_mb": round(model_memory_bytes(model) / 2**20, 1),
+        "rss_mb": round(process_rss_bytes() / 2**20, 1),
+        "device": "cpu",
+        "batch_max_size": BATCH_MAX_SIZE,
+        "batch_window_ms": BATCH_WINDOW_MS,
+        "speculative": SPECULATIVE if state.speculative else None,
+        "structure_stop": STRUCTURE_STOP,
+        "load_seconds": round(state.load_seconds, 2),
+        "prefix_cache": state.prefix_cache.stats(),
+        "adapters": [a["name"] for a in adapters.list()] if adapters is not None else [DEFAULT_ADAPTER]
     }
 
+def create_app(state=None):
+    """Build the API around a ServingState.
+
+    Without one (`uvicorn serve.app:app`), a fresh state starts loading in the
+    background at startup, so the port is bound straight away: /healthz
+    answers at once, while /readyz and the model endpoints return 503 until the
+    model is ready. serve.workers passes a state it loaded before forking.
+    """
+    state = state or ServingState()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        state.start()
+        yield
+
+    # Runtime metrics at /metrics; forked workers pool theirs through METRICS_DIR
+    if METRICS_DIR:
+        telemetry.share(METRICS_DIR)
+    telemetry.gauge("wsl_model_ready", "1 once the model is loaded and serving", lambda: float(state.ready))
+    telemetry.gauge("wsl_queue_depth", "Jobs waiting for the model thread",
+                    lambda: state.scheduler.depth() if state.ready else 0)
+
+    app = FastAPI(title="WSLAnalytics API", version="1.0", lifespan=lifespan)
+    app.state.serving = state
+
+    @app.exception_handler(Rejected)
+    async def rejected(request, exc):
+        telemetry.count_rejected(exc.reason)
+        return JSONResponse({"detail": str(exc)}, status_code=exc.status, headers=exc.headers())
+
+    @app.exception_handler(UnknownAdapter)
+    async def unknown_adapter(request, exc):
+        # Unregistered while the request was queued (the up-front check passed)
+        return JSONResponse({"detail": str(exc)}, status_code=404)
+    app.include_router(router)
+    return app
+
+app = create_app()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
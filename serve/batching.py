@@ -0,0 +1,448 @@
+import os, math, queue, threading, time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from serve.admission import ClientGone, DeadlineExceeded, QueueFull
+from serve.json_constraint import JsonComplete, JsonLogitsProcessor, JsonRows, json_index
+from serve.stopping import RowStops, StructureStop
+from serve.telemetry import telemetry
+
+
+@dataclass
+class GenerationJob:
+    """One caller's prompt plus its own sampling parameters"""
+    prompt: str
+    max_tokens: int = 220
+    temperature: float = 0.3
+    top_p: float = 0.9
+    seed: Optional[int] = None
+    adapter: Optional[str] = None
+    response_format: Optional[str] = None  # "json": constrain decoding to one JSON value
+    stop: Optional[List[str]] = None  # finish (and cut the text) at the first of these
+    kind: Optional[str] = None  # preview/recap/thread/caption: stop at the house-style structure's end
+    deadline: Optional[float] = None  # time.monotonic() by which the result is needed
+    cancelled: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+
+    def abandoned(self):
+        """The error to fail this job with if its caller has gone or its deadline has passed, else None"""
+        if self.cancelled.is_set():
+            return ClientGone("Client disconnected")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return DeadlineExceeded("Request deadline passed before generation finished")
+        return None
+
+
+SAMPLE_TOP_K = 50
+
+
+class PerRowSampler(LogitsProcessor):
+    """Sample each row with its own temperature/top-p and leave only the chosen token finite.
+
+    `generate` then runs greedy, so the argmax is exactly the token sampled here.
+    Rows with temperature <= 0 are decoded greedily; rows with a seed draw from
+    their own generator, so the same seed in the same batch composition gives
+    the same output (padding and batched matmuls can still shift the logits when
+    the batch changes).
+    """
+
+    def __init__(self, temperatures, top_ps, seeds=None, top_k=SAMPLE_TOP_K):
+        self.temperatures = torch.tensor(temperatures, dtype=torch.float32).unsqueeze(1)
+        self.top_ps = torch.tensor(top_ps, dtype=torch.float32).unsqueeze(1)
+        self.greedy = self.temperatures.squeeze(1) <= 0
+        self.top_k = top_k
+        self.generators = {
+            i: torch.Generator().manual_seed(seed)
+            for i, seed in enumerate(seeds or []) if seed is not None
+        }
+
+    def __call__(self, input_ids, scores):
+        scores = scores.float()
+        choice = scores.argmax(dim=-1)
+
+        if not bool(self.greedy.all()):
+            logits = scores / self.temperatures.clamp(min=1e-5)
+            if self.top_k:
+                kth = logits.topk(min(self.top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+                logits = logits.masked_fill(logits < kth, float("-inf"))
+            probs = torch.softmax(logits, dim=-1)
+
+            # Nucleus filter: keep the smallest set of tokens whose mass reaches top_p
+            # (always at least the most likely one, so a tiny top_p can't leave nothing to sample)
+            sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+            mass_before = sorted_probs.cumsum(dim=-1) - sorted_probs
+            drop = mass_before >= self.top_ps
+            drop[:, 0] = False
+            sorted_probs = sorted_probs.masked_fill(drop, 0.0)
+            probs = torch.zeros_like(probs).scatter(1, sorted_idx, sorted_probs)
+
+            sampled = torch.multinomial(probs, 1).squeeze(1)
+            for i, gen in self.generators.items():
+                sampled[i] = torch.multinomial(probs[i], 1, generator=gen)[0]
+            choice = torch.where(self.greedy, choice, sampled)
+
+        out = torch.full_like(scores, float("-inf"))
+        return out.scatter(1, choice.unsqueeze(1), 0.0)
+
+
+class PerRowMaxNewTokens(StoppingCriteria):
+    """Finish each row once it has produced its own max_tokens"""
+
+    def __init__(self, prompt_len, max_new_tokens):
+        self.prompt_len = prompt_len
+        self.limits = torch.tensor(max_new_tokens)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return (input_ids.shape[1] - self.prompt_len) >= self.limits
+
+
+class RowCancel(StoppingCriteria):
+    """Finish rows whose caller disconnected or whose deadline passed, freeing the batch sooner"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor([j.abandoned() is not None for j in self.jobs])
+
+
+class StageTimer(StoppingCriteria):
+    """Never stops anything; notes when `generate` finishes prefill and produces its first token.
+
+    Stopping criteria run once per decoding step after the new token is
+    appended, so the first call marks the end of prefill. Call `finish`
+    after `generate` returns to record prefill and per-token decode time.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first is None:
+            self.first = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool)
+
+    def finish(self, steps, rows=1):
+        """Record prefill and decode time for a call that ran `steps` steps (new tokens per row) over `rows` rows"""
+        end = time.perf_counter()
+        first = self.first or end
+        telemetry.observe_stage("prefill", first - self.started)
+        if steps > 1 and end > first:
+            telemetry.observe_stage("decode_per_token", (end - first) / (steps - 1))
+            telemetry.set_decode_rate(rows * (steps - 1) / (end - first))
+
+
+def speculative_options(jobs, speculative):
+    """`generate` kwargs for decoding a group speculatively, or None if it can't be.
+
+    Assisted generation handles one row at a time, and vets proposed tokens by
+    running the logits processors over placeholder logits, which PerRowSampler
+    would reject. So the row is decoded by `generate` itself: greedy, or
+    sampled with the same temperature/top-k/top-p filtering, which verification
+    keeps exact. Seeded rows are left out: rejected proposals consume their
+    random numbers, so the same seed would give a different text than without
+    speculation or in a batch.
+    """
+    if not speculative or len(jobs) != 1:
+        return None
+    job = jobs[0]
+    if job.temperature <= 0:
+        return {**speculative, "do_sample": False}
+    if job.seed is not None:
+        return None
+    return {**speculative, "do_sample": True, "temperature": job.temperature, "top_p": job.top_p, "top_k": SAMPLE_TOP_K}
+
+
+def decoding_hooks(tok, jobs, prompt_len, sample=True):
+    """Logits processors and stopping criteria applying each job's own settings.
+
+    Rows asking for JSON are masked to tokens that keep their output a valid
+    JSON prefix and stop as soon as the value closes; the sampler then picks
+    from whatever is left (sample=False leaves picking to `generate`). Rows
+    with stop strings or a content kind get incremental structure checks.
+    Rows are also finished early once their job is abandoned (see RowCancel).
+    Returns (processors, stopping criteria, {row: RowStops}) so callers can
+    trim text where a rule fired.
+    """
+    processors = []
+    stops = [PerRowMaxNewTokens(prompt_len, [j.max_tokens for j in jobs]), RowCancel(jobs)]
+    structure = {i: RowStops(tok, j.stop, j.kind) for i, j in enumerate(jobs) if j.stop or j.kind}
+    if structure:
+        stops.append(StructureStop(structure, prompt_len))
+    json_rows = [i for i, j in enumerate(jobs) if j.response_format == "json"]
+    if json_rows:
+        rows = JsonRows(json_index(tok), json_rows, prompt_len)
+        processors.append(JsonLogitsProcessor(rows))
+        stops.append(JsonComplete(rows))
+    if sample:
+        processors.append(PerRowSampler(
+            [j.temperature for j in jobs], [j.top_p for j in jobs], [j.seed for j in jobs]
+        ))
+    return LogitsProcessorList(processors), StoppingCriteriaList(stops), structure
+
+
+def build_inputs(tok, ids, prefix=None):
+    """Pad tokenised prompts into one batch, optionally sharing a cached prefix.
+
+    Without a prefix the prompts are left-padded. With one, every row starts
+    with the prefix ids and the remainders are padded in between, so the
+    cached keys/values line up for all rows and positions skip the padding.
+    Returns (input_ids, attention_mask, past_key_values or None).
+    """
+    start = len(prefix) if prefix is not None else 0
+    rests = [x[start:] for x in ids]
+    width = max(len(x) for x in rests)
+    input_ids = torch.full((len(ids), start + width), tok.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+
+    for i, rest in enumerate(rests):
+        if start:
+            input_ids[i, :start] = torch.tensor(prefix.ids)
+            attention_mask[i, :start] = 1
+        input_ids[i, start + width - len(rest):] = torch.tensor(rest)
+        attention_mask[i, start + width - len(rest):] = 1
+
+    past = prefix.expand(len(ids)) if prefix is not None else None
+    return input_ids, attention_mask, past
+
+
+def prepare_group(model, rows, prefix=None, adapter=None, prefix_cache=None, adapters=None):
+    """Resolve a group's adapter and cached prefix state.
+
+    Returns (prefix state or None, extra `generate` kwargs selecting the adapter).
+    """
+    extra, key = {}, None
+    if adapters is not None:
+        name = adapters.acquire(adapter)
+        extra["adapter_names"] = [name] * rows
+        key = adapters.cache_key(name)
+    state = None
+    if prefix is not None:
+        forward = {"adapter_names": [extra["adapter_names"][0]]} if extra else {}
+        state = prefix_cache.get(model, prefix, key, **forward)
+    return state, extra
+
+
+def _generate_group(model, tok, jobs, ids, prefix=None, extra=None, speculative=None):
+    input_ids, attention_mask, past = build_inputs(tok, ids, prefix)
+    prompt_len = input_ids.shape[1]
+    limits = [j.max_tokens for j in jobs]
+
+    spec = speculative_options(jobs, speculative)
+    processors, stops, structure = decoding_hooks(tok, jobs, prompt_len, sample=spec is None)
+    timer = StageTimer()
+    stops.append(timer)
+
+    extra = dict(extra or {})
+    if past is not None:
+        extra["past_key_values"] = past
+    extra.update(spec or {"do_sample": False})
+    with torch.inference_mode():
+        output = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max(limits),
+            logits_processor=processors,
+            stopping_criteria=stops,
+            pad_token_id=tok.pad_token_id,
+            **extra,
+        )
+    timer.finish(output.shape[1] - prompt_len, len(jobs))
+
+    results = []
+    for i, job in enumerate(jobs):
+        error = job.abandoned()
+        if error is not None:
+            results.append(error)
+            continue
+        started = time.perf_counter()
+        new_ids = output[i, prompt_len:prompt_len + job.max_tokens]
+        # Rows that finish early are padded with EOS (== pad); don't count those
+        n_generated = int((new_ids != tok.pad_token_id).sum())
+        if i in structure and structure[i].cut is not None:
+            text = structure[i].final_text()
+        else:
+            text = tok.decode(new_ids, skip_special_tokens=True).strip()
+        telemetry.observe_stage("detokenize", time.perf_counter() - started)
+        telemetry.count_generated(n_generated)
+        results.append({
+            "text": text,
+            "prompt_tokens": len(ids[i]),
+            "generated_tokens": n_generated,
+            "cached_prefix_tokens": len(prefix) if prefix is not None else 0,
+        })
+    return results
+
+
+def generate_batch(model, tok, jobs, prefix_cache=None, adapters=None, speculative=None):
+    """Run batched `generate` for a list of jobs and return one result per job.
+
+    Jobs are grouped by adapter and cached prompt prefix: each group shares
+    one call that decodes from the cached state (or a plain left-padded
+    batch). Single-row groups use the `speculative` generate kwargs, if any.
+    A group that fails yields its exception in place of results.
+    """
+    ids = []
+    for job in jobs:
+        started = time.perf_counter()
+        ids.append(tok(job.prompt)["input_ids"])
+        telemetry.observe_stage("tokenize", time.perf_counter() - started)
+        telemetry.count_prompt(len(ids[-1]))
+
+    groups = {}
+    for i, (job, x) in enumerate(zip(jobs, ids)):
+        prefix = prefix_cache.match(x) if prefix_cache is not None else None
+        groups.setdefault((job.adapter, prefix), []).append(i)
+
+    results = [None] * len(jobs)
+    for (adapter, prefix), idx in groups.items():
+        try:
+            state, extra = prepare_group(model, len(idx), prefix, adapter, prefix_cache, adapters)
+            out = _generate_group(model, tok, [jobs[i] for i in idx], [ids[i] for i in idx], state, extra,
+                                  speculative)
+        except Exception as e:
+            out = [e] * len(idx)
+        for i, r in zip(idx, out):
+            results[i] = r
+    return results
+
+
+class BatchScheduler:
+    """Gather concurrent jobs for a short window and run them as one batch.
+
+    A single worker thread owns the model, so requests never run `generate`
+    side by side and fight over the same cores. Work that can't be batched
+    (e.g. streaming) is queued with `run_exclusive` and runs between batches.
+
+    With max_queue set, `submit` raises QueueFull once that many jobs are
+    waiting, and DeadlineExceeded when the expected queue wait already runs
+    past a job's deadline. Jobs abandoned while queued are dropped unrun.
+    Exclusive work is always accepted and isn't counted in the queue depth
+    or the batch-time average that admission is based on.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, window_ms=10, max_queue=0):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = max(0.0, window_ms / 1000.0)
+        self.max_queue = max(0, max_queue)
+        self._batch_seconds = 0.0  # moving average of one batch's run time
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._pending = deque()
+        self._exclusive = 0  # queued run_exclusive calls, left out of depth()
+
+    def submit(self, job):
+        """Queue a job and return a Future resolving to its result dict"""
+        self._ensure_worker()
+        depth = self.depth()
+        if self.max_queue and depth >= self.max_queue:
+            raise QueueFull(f"Server busy: {depth} requests queued", retry_after=self.expected_wait(depth))
+        deadline = getattr(job, "deadline", None)
+        if deadline is not None and time.monotonic() + self.expected_wait(depth) > deadline:
+            raise DeadlineExceeded("Request can't be served before its deadline",
+                                   retry_after=self.expected_wait(depth))
+        fut = Future()
+        self._queue.put((job, fut, time.perf_counter()))
+        return fut
+
+    def run_exclusive(self, fn):
+        """Queue fn() to run alone on the model thread; returns a Future of its result"""
+        self._ensure_worker()
+        fut = Future()
+        with self._lock:
+            self._exclusive += 1
+        self._queue.put((fn, fut, time.perf_counter()))
+        return fut
+
+    def _ensure_worker(self):
+        # Threads don't survive fork, so start (or restart) lazily in the serving process
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pending = deque()
+                self._exclusive = 0
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+            self._thread.start()
+
+    def _collect(self):
+        first = self._pending.popleft() if self._pending else self._queue.get()
+        if callable(first[0]):
+            with self._lock:
+                self._exclusive -= 1
+            return [first]
+
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if callable(item[0]):
+                # Exclusive work closes the window; it runs right after this batch
+                self._pending.append(item)
+                break
+            batch.append(item)
+        return batch
+
+    def depth(self):
+        """Jobs waiting for the model thread (exclusive work not included)"""
+        return max(0, self._queue.qsize() + len(self._pending) - self._exclusive)
+
+    def expected_wait(self, depth=None):
+        """Rough seconds until a job queued now starts, from recent batch times"""
+        depth = self.depth() if depth is None else depth
+        return math.ceil(depth / self.max_batch_size) * self._batch_seconds
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            now = time.perf_counter()
+            live = []
+            for job, fut, queued in batch:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                telemetry.observe_stage("queue_wait", now - queued)
+                error = None if callable(job) else job.abandoned()
+                if error is not None:
+                    fut.set_exception(error)  # timed out or cancelled while queued
+                else:
+                    live.append((job, fut))
+            if not live:
+                continue
+            if callable(live[0][0]):
+                fn, fut = live[0]
+                try:
+                    fut.set_result(fn())
+                except Exception as e:
+                    fut.set_exception(e)
+                # Not recorded: a long stream would inflate the batch time admission estimates from
+                continue
+            try:
+                results = self.run_batch([job for job, _ in live])
+            except Exception as e:
+                for _, fut in live:
+                    fut.set_exception(e)
+                continue
+            self._record(now)
+            for (_, fut), result in zip(live, results):
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+
+    def _record(self, started):
+        elapsed = time.perf_counter() - started
+        self._batch_seconds = elapsed if not self._batch_seconds else 0.8 * self._batch_seconds + 0.2 * elapsed
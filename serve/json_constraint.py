@@ -0,0 +1,286 @@
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+# --- Character-level JSON prefix automaton -------------------------------------------
+# A state is (stack, mode, aux): stack holds the open "{"/"[" brackets, mode says what
+# may come next and aux carries the mode's detail (string escapes, number part,
+# remaining literal characters, or the length of the current whitespace run between
+# tokens). States are plain tuples so they can key a cache.
+VALUE, VALUE_OR_END, KEY, KEY_OR_END, COLON, AFTER, STR, NUM, LIT, DONE = range(10)
+
+START = ((), VALUE, None)
+MAX_DEPTH = 16
+# Longest whitespace run allowed between tokens: enough for indented output, but a
+# model can't spend its whole budget on blank lines inside an unfinished object
+MAX_WHITESPACE = 12
+WHITESPACE = " \t\n\r"
+HEX = set("0123456789abcdefABCDEF")
+LITERALS = {"t": "rue", "f": "alse", "n": "ull"}
+
+# Number parts: "-" sign, "0" leading zero, "int", "." point, "frac", "e" exponent mark,
+# "esign" exponent sign, "exp"; a number may end after "0", "int", "frac" or "exp"
+NUM_END = {"0", "int", "frac", "exp"}
+
+
+def _num_step(part, c):
+    digit = "0" <= c <= "9"
+    if part == "-":
+        return "0" if c == "0" else "int" if digit else None
+    if part in ("0", "int", "frac"):
+        if digit and part != "0":
+            return part
+        if c == "." and part != "frac":
+            return "."
+        if c in "eE":
+            return "e"
+        return None
+    if part == ".":
+        return "frac" if digit else None
+    if part == "e":
+        return "esign" if c in "+-" else "exp" if digit else None
+    if part in ("esign", "exp"):
+        return "exp" if digit else None
+    return None
+
+
+def _after(stack):
+    return (stack, AFTER, None) if stack else ((), DONE, None)
+
+
+def _start_value(stack, c):
+    if c in "{[":
+        if len(stack) >= MAX_DEPTH:
+            return None
+        return (stack + (c,), KEY_OR_END if c == "{" else VALUE_OR_END, None)
+    if not stack:
+        return None  # the top-level value must be an object or array
+    if c == '"':
+        return (stack, STR, (False, 0))
+    if c == "-":
+        return (stack, NUM, "-")
+    if "0" <= c <= "9":
+        return (stack, NUM, "0" if c == "0" else "int")
+    if c in LITERALS:
+        return (stack, LIT, LITERALS[c])
+    return None
+
+
+def json_step(state, c):
+    """State after appending character c, or None if the text stops being a JSON prefix"""
+    stack, mode, aux = state
+    if mode == STR:
+        is_key, esc = aux
+        if esc == 0:
+            if c == '"':
+                return (stack, COLON, None) if is_key else _after(stack)
+            if c == "\\":
+                return (stack, STR, (is_key, 1))
+            return None if c < " " else state
+        if esc == 1:
+            if c in '"\\/bfnrt':
+                return (stack, STR, (is_key, 0))
+            return (stack, STR, (is_key, 5)) if c == "u" else None
+        # \uXXXX: esc counts down 5, 4, 3, 2 over the four hex digits
+        return (stack, STR, (is_key, esc - 1 if esc > 2 else 0)) if c in HEX else None
+    if mode == NUM:
+        part = _num_step(aux, c)
+        if part is not None:
+            return (stack, NUM, part)
+        # The number ended; c belongs to whatever follows it
+        return json_step(_after(stack), c) if aux in NUM_END else None
+    if mode == LIT:
+        if c != aux[0]:
+            return None
+        return (stack, LIT, aux[1:]) if len(aux) > 1 else _after(stack)
+    if mode == DONE:
+        return None
+    if c in WHITESPACE:
+        run = aux or 0
+        return (stack, mode, run + 1) if run < MAX_WHITESPACE else None
+    if mode == COLON:
+        return (stack, VALUE, None) if c == ":" else None
+    if mode in (KEY, KEY_OR_END):
+        if c == '"':
+            return (stack, STR, (True, 0))
+        if c == "}" and mode == KEY_OR_END:
+            return _after(stack[:-1])
+        return None
+    if mode == AFTER:
+        top = stack[-1]
+        if c == ",":
+            return (stack, KEY if top == "{" else VALUE, None)
+        if (c == "}" and top == "{") or (c == "]" and top == "["):
+            return _after(stack[:-1])
+        return None
+    if c == "]" and mode == VALUE_OR_END:
+        return _after(stack[:-1])
+    return _start_value(stack, c)
+
+
+def json_advance(state, text):
+    """json_step over a string; None as soon as it leaves the JSON prefix language"""
+    for c in text:
+        state = json_step(state, c)
+        if state is None:
+            return None
+    return state
+
+
+def is_complete(state):
+    return state is not None and state[1] == DONE
+
+
+# --- Token index ------------------------------------------------------------------------
+def token_pieces(tok):
+    """Text each token id contributes when it follows ordinary text ("" for unusable ids).
+
+    Decoding [anchor, id] and removing the anchor keeps leading spaces that
+    tokenizers drop at the start of a sequence. Special tokens and byte pieces
+    that only form part of a UTF-8 character are left empty.
+    """
+    anchor = tok("a", add_special_tokens=False)["input_ids"][-1]
+    head = tok.decode([anchor], clean_up_tokenization_spaces=False)
+    special = set(tok.all_special_ids)
+    decoded = tok.batch_decode([[anchor, i] for i in range(len(tok))], clean_up_tokenization_spaces=False)
+    pieces = []
+    for i, text in enumerate(decoded):
+        piece = text[len(head):] if text.startswith(head) else ""
+        pieces.append("" if i in special or "�" in piece else piece)
+    return pieces
+
+
+class JsonTokenIndex:
+    """Which tokens keep the output a valid JSON prefix, per automaton state.
+
+    Token pieces are stored in a character trie; the allowed set for a state is
+    found by walking the trie while stepping the automaton, pruning a whole
+    subtree the moment its prefix becomes invalid. Results are cached as vocab
+    masks per state, and JSON output revisits few distinct states, so after
+    warm-up each decoding step is a dictionary lookup.
+    """
+
+    def __init__(self, tok, cache_size=2048):
+        self.eos_token_id = tok.eos_token_id
+        self.pieces = token_pieces(tok)
+        self.vocab_size = len(self.pieces)
+        self._trie = ({}, [])
+        for i, piece in enumerate(self.pieces):
+            if not piece:
+                continue
+            node = self._trie
+            for c in piece:
+                node = node[0].setdefault(c, ({}, []))
+            node[1].append(i)
+        self._masks = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def advance(self, state, token_id):
+        """State after a generated token; special tokens (EOS/padding) leave it unchanged"""
+        if state is None or token_id >= self.vocab_size or not self.pieces[token_id]:
+            return state
+        return json_advance(state, self.pieces[token_id])
+
+    def allowed(self, state):
+        """Bool mask over the vocabulary of tokens permitted in state"""
+        with self._lock:
+            mask = self._masks.get(state)
+            if mask is not None:
+                self._masks.move_to_end(state)
+                return mask
+
+        mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+        if state is None or is_complete(state):
+            # Finished (or off the rails): the only way forward is to stop
+            if self.eos_token_id is not None:
+                mask[self.eos_token_id] = True
+        else:
+            ids, todo = [], [(self._trie, state)]
+            while todo:
+                (children, here), st = todo.pop()
+                ids.extend(here)
+                for c, child in children.items():
+                    nxt = json_step(st, c)
+                    if nxt is not None:
+                        todo.append((child, nxt))
+            mask[ids] = True
+
+        with self._lock:
+            self._masks[state] = mask
+            if len(self._masks) > self._cache_size:
+                self._masks.popitem(last=False)
+        return mask
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def json_index(tok):
+    """Shared JsonTokenIndex for a tokenizer, built on first use"""
+    with _indexes_lock:
+        index = _indexes.get(id(tok))
+        if index is None:
+            index = _indexes[id(tok)] = JsonTokenIndex(tok)
+        return index
+
+
+# --- generate() hooks ------------------------------------------------------------------
+class JsonRows:
+    """Per-row automaton state for the constrained rows of one generate call.
+
+    Each row keeps the tokens it has consumed and the state after each, and
+    re-syncs against input_ids by their common prefix, so calls with rolled-back
+    or speculative continuations are handled as well as plain one-token steps.
+    """
+
+    def __init__(self, index, rows, prompt_len):
+        self.index = index
+        self.prompt_len = prompt_len
+        self.tokens = {i: [] for i in rows}
+        self.states = {i: [START] for i in rows}
+
+    def state(self, input_ids, i):
+        new = input_ids[i, self.prompt_len:].tolist()
+        tokens, states = self.tokens[i], self.states[i]
+        n = len(tokens)
+        if new[:n] != tokens:
+            n = 0
+            while n < len(tokens) and n < len(new) and tokens[n] == new[n]:
+                n += 1
+        del tokens[n:], states[n + 1:]
+        for t in new[n:]:
+            states.append(self.index.advance(states[-1], t))
+            tokens.append(t)
+        return states[-1]
+
+
+class JsonLogitsProcessor(LogitsProcessor):
+    """Mask constrained rows' logits down to tokens that keep their output valid JSON"""
+
+    def __init__(self, rows: JsonRows):
+        self.rows = rows
+
+    def __call__(self, input_ids, scores):
+        n = min(self.rows.index.vocab_size, scores.shape[-1])
+        for i in self.rows.tokens:
+            mask = self.rows.index.allowed(self.rows.state(input_ids, i))
+            scores[i, :n] = scores[i, :n].masked_fill(~mask[:n], float("-inf"))
+            scores[i, n:] = float("-inf")
+        return scores
+
+
+class JsonComplete(StoppingCriteria):
+    """Finish a constrained row as soon as its top-level JSON value closes"""
+
+    def __init__(self, rows: JsonRows):
+        self.rows = rows
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool)
+        for i in self.rows.tokens:
+            done[i] = is_complete(self.rows.state(input_ids, i))
+        return done
@@ -0,0 +1,140 @@
+import os, json, struct
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from serve.telemetry import process_rss_bytes  # re-exported for callers of serve.loading
+
+# safetensors dtype tags -> torch dtypes
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+MERGED_WEIGHTS = "model.safetensors"
+
+
+def load_tokenizer(name):
+    """Load tokenizer with the padding setup used for generation"""
+    tok = AutoTokenizer.from_pretrained(name, use_fast=True)
+    tok.pad_token = tok.eos_token
+    tok.padding_side = "left"  # batched generation appends on the right
+    return tok
+
+
+def mmap_safetensors(path):
+    """Map a .safetensors file into tensors without copying the weights into RAM.
+
+    Pages are read lazily from the OS page cache, so processes that map the
+    same file share one physical copy.
+    """
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+
+    data_start = 8 + header_len
+    size = os.path.getsize(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=size)
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        offset = data_start + start
+        t = torch.empty(0, dtype=dtype)
+        if offset % itemsize == 0:
+            t.set_(storage, offset // itemsize, info["shape"])
+        else:
+            # Misaligned entry (never for our fp32 exports): fall back to a copy
+            raw = torch.empty(0, dtype=torch.uint8).set_(storage, offset, (end - start,))
+            t = raw.clone().view(dtype).reshape(info["shape"])
+        tensors[name] = t
+    return tensors
+
+
+def has_merged_checkpoint(merged_dir):
+    """True when `train/merge_adapter.py` has exported a checkpoint to merged_dir"""
+    return bool(merged_dir) and os.path.isfile(os.path.join(merged_dir, MERGED_WEIGHTS))
+
+
+def load_merged(merged_dir):
+    """Build the model skeleton without allocating weights, then attach the mapped tensors"""
+    from accelerate import init_empty_weights
+
+    config = AutoConfig.from_pretrained(merged_dir)
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32)
+
+    state = mmap_safetensors(os.path.join(merged_dir, MERGED_WEIGHTS))
+    model.load_state_dict(state, strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [n for n, p in model.named_parameters() if p.is_meta]
+    if missing:
+        raise RuntimeError(f"Merged checkpoint in {merged_dir} is missing weights: {missing[:5]}")
+    return model.eval()
+
+
+def quantize_model(model, mode):
+    """Apply dynamic int8 quantisation to the Linear layers (mode "int8"); "" / "none" is a no-op.
+
+    LoRA adapters are merged first so the quantised weights include them.
+    lm_head is left in fp32: it is the most quality-sensitive projection.
+    """
+    if mode in (None, "", "none", "fp32"):
+        return model
+    if mode != "int8":
+        raise ValueError(f"Unsupported QUANTIZE mode: {mode!r} (expected 'int8')")
+
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+
+    from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+    spec = {
+        name: per_channel_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and name != "lm_head"
+    }
+    return quantize_dynamic(model, spec, dtype=torch.qint8, inplace=True).eval()
+
+
+def model_memory_bytes(model):
+    """Bytes held by the model's weights and buffers, including packed int8 weights"""
+    def size(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(size(v) for v in value)
+        return 0
+
+    seen, total = set(), 0
+    for value in model.state_dict(keep_vars=True).values():
+        if isinstance(value, torch.Tensor):
+            # Tied weights appear under several names
+            if value.data_ptr() in seen:
+                continue
+            seen.add(value.data_ptr())
+        total += size(value)
+    return total
+
+
+def load_model(base, adapter, merged_dir=None):
+    """Load the merged checkpoint if one exists, else the fp32 base wrapped with the LoRA adapter.
+
+    Returns (model, source) where source says which path was taken.
+    """
+    if has_merged_checkpoint(merged_dir):
+        return load_merged(merged_dir), "merged"
+
+    from peft import PeftModel
+
+    base_model = AutoModelForCausalLM.from_pretrained(
+        base,
+        torch_dtype=torch.float32,
+        device_map="cpu"
+    )
+    model = PeftModel.from_pretrained(base_model, adapter)
+    return model.eval(), "adapter"
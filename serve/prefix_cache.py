@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+
+def known_prefixes():
+    """Preamble shared by every instruction built in scripts/build_sft_pairs.py.
+
+    The per-kind STYLE/RULES block follows the post's title and context, so
+    the system cue is the part every preview/recap/thread/caption prompt shares.
+    """
+    from scripts.build_sft_pairs import SYSTEM_CUE
+    return [f"<s>{SYSTEM_CUE}</s>\n<TITLE>"]
+
+
+class CachedPrefix:
+    """Token ids of a prompt prefix plus its per-layer key/value tensors (batch of 1)"""
+
+    def __init__(self, ids, kv):
+        self.ids = ids
+        self.kv = kv
+
+    def __len__(self):
+        return len(self.ids)
+
+    def expand(self, batch_size):
+        """Fresh DynamicCache holding this prefix for batch_size rows"""
+        cache = DynamicCache()
+        for layer, (k, v) in enumerate(self.kv):
+            cache.update(
+                k.expand(batch_size, -1, -1, -1),
+                v.expand(batch_size, -1, -1, -1),
+                layer,
+            )
+        return cache
+
+
+def _layer_tensors(past_key_values):
+    """Per-layer (key, value) pairs from a Cache object or legacy tuple"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return tuple((k.detach(), v.detach()) for k, v in past_key_values)
+
+
+class PrefixKVCache:
+    """LRU cache of past_key_values for known prompt prefixes.
+
+    Prefixes are registered as text and matched at token level, so a prompt
+    only reuses a cached state when its tokenisation really starts with the
+    prefix ids. States are computed on first use and evicted least recently
+    used once more than `capacity` are resident.
+    """
+
+    def __init__(self, tok, prefixes, capacity=8):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+        self._prefixes = []
+        for text in prefixes:
+            ids = tok(text)["input_ids"]
+            # Drop the boundary token: it may merge with whatever text follows
+            ids = tuple(ids[:-1])
+            if ids and ids not in self._prefixes:
+                self._prefixes.append(ids)
+        # Longest first, so the most specific prefix wins
+        self._prefixes.sort(key=len, reverse=True)
+
+    def match(self, ids):
+        """Longest registered prefix that is a proper prefix of ids, or None"""
+        if self.capacity <= 0:
+            return None
+        for prefix in self._prefixes:
+            if len(prefix) < len(ids) and tuple(ids[:len(prefix)]) == prefix:
+                return prefix
+        return None
+
+    def get(self, model, prefix, key=None, **forward_kwargs):
+        """Cached state for prefix under key (e.g. adapter), computing it on a miss"""
+        slot = (key, prefix)
+        with self._lock:
+            if slot in self._states:
+                self._states.move_to_end(slot)
+                self.hits += 1
+                return self._states[slot]
+            self.misses += 1
+
+        with torch.inference_mode():
+            out = model(input_ids=torch.tensor([prefix]), use_cache=True, **forward_kwargs)
+        state = CachedPrefix(list(prefix), _layer_tensors(out.past_key_values))
+
+        with self._lock:
+            self._states[slot] = state
+            self._states.move_to_end(slot)
+            while len(self._states) > self.capacity:
+                self._states.popitem(last=False)
+        return state
+
+    def stats(self):
+        with self._lock:
+            return {
+                "prefixes": len(self._prefixes),
+                "resident": len(self._states),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
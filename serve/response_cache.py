@@ -0,0 +1,127 @@
+import os, json, time, sqlite3, hashlib, threading, unicodedata
+from collections import OrderedDict
+
+
+def is_deterministic(temperature, seed=None):
+    """Greedy decoding or a caller-fixed seed always gives the same text"""
+    return temperature <= 0 or seed is not None
+
+
+def normalise_prompt(prompt):
+    """Canonical form for cache keys: NFC unicode and LF line endings"""
+    return unicodedata.normalize("NFC", prompt.replace("\r\n", "\n"))
+
+
+def weights_fingerprint(*paths):
+    """Identity of the served weights: each path plus the size/mtime of its files"""
+    parts = []
+    for path in paths:
+        parts.append(str(path))
+        if path and os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith((".safetensors", ".bin")):
+                    st = os.stat(os.path.join(path, name))
+                    parts.append(f"{name}:{st.st_size}:{int(st.st_mtime)}")
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+
+def request_key(prompt, max_tokens, temperature, top_p, seed, adapter, response_format=None, stop=None, kind=None):
+    """Cache key for a deterministic request"""
+    params = {"max_tokens": max_tokens}
+    if response_format:
+        params["response_format"] = response_format
+    if stop:
+        params["stop"] = list(stop)
+    if kind:
+        params["kind"] = kind
+    if temperature <= 0:
+        # Greedy: top_p and seed don't influence the output
+        params["temperature"] = 0
+    else:
+        params.update(temperature=temperature, top_p=top_p, seed=seed)
+    blob = json.dumps([normalise_prompt(prompt), params, adapter], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Size-bounded in-memory LRU of responses with an optional sqlite tier behind it"""
+
+    def __init__(self, capacity=1024, db_path=None):
+        self.capacity = capacity
+        self.db_path = db_path or None
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._conn = None
+        self._pid = None
+        if self.db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+
+    @property
+    def _db(self):
+        """sqlite connection for this process (connections must not cross a fork)"""
+        if not self.db_path:
+            return None
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits["memory"] += 1
+                return self._items[key]
+            db = self._db
+            if db is not None:
+                row = db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.hits["disk"] += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            db = self._db
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), time.time()),
+                )
+                db.commit()
+
+    def _remember(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            hits = self.hits["memory"] + self.hits["disk"]
+            total = hits + self.misses
+            stats = {
+                "enabled": True,
+                "resident": len(self._items),
+                "capacity": self.capacity,
+                "hits": hits,
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 4) if total else None,
+                "db_path": self.db_path,
+            }
+            db = self._db
+            if db is not None:
+                stats["disk_entries"] = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return stats
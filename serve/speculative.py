@@ -0,0 +1,32 @@
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# SPECULATIVE modes: "" (off), "prompt_lookup" (n-gram drafts copied from the prompt),
+# "draft" (a small model sharing the tokenizer proposes the tokens)
+MODES = ("", "off", "none", "prompt_lookup", "draft")
+
+
+def load_draft_model(path, tok):
+    """Load a small draft model for assisted decoding; it must use the served tokenizer's vocabulary"""
+    draft_tok = AutoTokenizer.from_pretrained(path, use_fast=True)
+    if draft_tok.get_vocab() != tok.get_vocab():
+        raise ValueError(f"Draft model {path} uses a different vocabulary from the served tokenizer")
+    return AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch.float32).eval()
+
+
+def speculative_kwargs(mode, tok=None, lookup_tokens=10, ngram_size=2, draft_path="", draft_tokens=5):
+    """Extra `generate` kwargs for a speculative mode, or None when it is off.
+
+    Either way the served model verifies every proposed token in one forward
+    pass and keeps the longest prefix it would have produced itself, so the
+    output is the same as without speculation; only the forward count changes.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unsupported SPECULATIVE mode: {mode!r} (expected 'prompt_lookup' or 'draft')")
+    if mode == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": lookup_tokens, "max_matching_ngram_size": ngram_size}
+    if mode == "draft":
+        if not draft_path:
+            raise ValueError("SPECULATIVE=draft needs DRAFT_MODEL")
+        return {"assistant_model": load_draft_model(draft_path, tok), "num_assistant_tokens": draft_tokens}
+    return None
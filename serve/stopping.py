@@ -0,0 +1,179 @@
+import re
+
+import torch
+from transformers import StoppingCriteria
+
+from scripts.build_sft_pairs import BULLET_LIMITS, kind_from_instruction
+
+# A numbered bullet: "3." / "3)" opening a line, or a keycap emoji (1️⃣ ... 🔟) anywhere
+BULLET_RE = re.compile(r"(?:^|\n)[ \t]*\d{1,2}[.)][ \t]|[0-9]\ufe0f?\u20e3|\U0001F51F")
+VERDICT_RE = re.compile(r"\bverdict\b", re.I)
+TRAILING_HASHTAGS_RE = re.compile(r"#\w+\s*$")
+# What a line ending in hashtags has to follow to close each kind: previews and
+# recaps end after their "Data Verdict", threads after their bullets (on the closer,
+# not a bullet), and a caption is a single paragraph that ends at its hashtags
+CLOSING_AFTER = {"preview": "verdict", "recap": "verdict", "thread": "bullets", "caption": None}
+# Longest text a bullet marker match can span, so a marker split across tokens is still seen
+BULLET_LOOKBACK = 8
+
+
+def resolve_kind(kind, prompt):
+    """Content kind for structure-based stopping: explicit, inferred from the prompt ("auto"), or None"""
+    if kind in (None, "none"):
+        return None
+    if kind == "auto":
+        return kind_from_instruction(prompt)
+    return kind
+
+
+class IncrementalDetokenizer:
+    """Decode a growing token sequence a few tokens at a time.
+
+    Only the window since the last emitted text is decoded each step (so
+    context-dependent spacing is kept), and text ending in an incomplete UTF-8
+    character is held back until the rest of it arrives.
+    """
+
+    def __init__(self, tok):
+        self.tok = tok
+        self.ids = []
+        self.text = ""
+        self._prefix = 0
+        self._read = 0
+
+    def _decode(self, ids):
+        return self.tok.decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+    def push(self, ids):
+        """Append token ids; returns the newly decoded text ("" while it is incomplete)"""
+        self.ids.extend(ids)
+        before = self._decode(self.ids[self._prefix:self._read])
+        after = self._decode(self.ids[self._prefix:])
+        if len(after) <= len(before) or after.endswith("�"):
+            return ""
+        delta = after[len(before):]
+        self._prefix, self._read = self._read, len(self.ids)
+        self.text += delta
+        return delta
+
+
+class RowStops:
+    """Stop rules and incremental state for one row.
+
+    - stop strings: finish when one appears; the text is cut before it
+    - closing hashtags: finish once a line ending in hashtags completes where
+      the kind's house style ends (see CLOSING_AFTER)
+    - bullet limit: finish when the kind's (limit + 1)th numbered bullet starts;
+      the text is cut before it
+    Only text decoded since the last step (plus a short overlap) is scanned.
+    """
+
+    def __init__(self, tok, stop=None, kind=None):
+        self.stop = [s for s in (stop or []) if s]
+        self.max_stop = max((len(s) for s in self.stop), default=0)
+        self.kind = kind
+        self.max_bullets = BULLET_LIMITS.get(kind) if kind else None
+        # How far back from the newest text a rule can still cut
+        self.holdback = max(self.max_stop - 1, BULLET_LOOKBACK if self.max_bullets is not None else 0)
+        self.reset(tok)
+
+    def reset(self, tok=None):
+        """Forget all generated text (e.g. when speculative tokens it saw were rejected)"""
+        self.detok = IncrementalDetokenizer(tok or self.detok.tok)
+        self.bullets = 0
+        self._last_bullet = -1
+        self._line_start = 0
+        self.verdict_seen = False
+        self.cut = None
+        self.done = False
+
+    @property
+    def text(self):
+        return self.detok.text
+
+    def update(self, new_ids):
+        """Feed newly generated ids; True once a rule says the row is finished"""
+        if self.done:
+            return True
+        start = len(self.detok.text)
+        if not self.detok.push(new_ids):
+            return False
+        text = self.detok.text
+
+        if self.stop:
+            window = max(0, start - self.max_stop + 1)
+            hits = [i for i in (text.find(s, window) for s in self.stop) if i >= 0]
+            if hits:
+                return self._finish(min(hits))
+
+        if self.max_bullets is not None:
+            for m in BULLET_RE.finditer(text, max(0, start - BULLET_LOOKBACK)):
+                if m.start() <= self._last_bullet:
+                    continue
+                self._last_bullet = m.start()
+                self.bullets += 1
+                if self.bullets > self.max_bullets:
+                    return self._finish(m.start())
+
+        if self.kind:
+            nl = text.find("\n", start)
+            while nl >= 0:
+                line = text[self._line_start:nl]
+                self._line_start = nl + 1
+                if VERDICT_RE.search(line):
+                    self.verdict_seen = True
+                if TRAILING_HASHTAGS_RE.search(line) and self._closes(line):
+                    return self._finish(nl)
+                nl = text.find("\n", nl + 1)
+        return False
+
+    def _closes(self, line):
+        """Whether a line ending in hashtags closes this row's kind"""
+        after = CLOSING_AFTER.get(self.kind, "verdict")
+        if after == "verdict":
+            return self.verdict_seen
+        if after == "bullets":
+            return self.bullets > 0 and not BULLET_RE.search(line)
+        return True
+
+    def _finish(self, cut):
+        self.cut = cut
+        self.done = True
+        return True
+
+    def settled(self):
+        """Length of the text no rule can cut any more (what a streamer may pass on).
+
+        Trailing whitespace is held back too, since the final text is stripped.
+        """
+        end = self.cut if self.done else max(0, len(self.detok.text) - self.holdback)
+        return len(self.detok.text[:end].rstrip())
+
+    def final_text(self):
+        """Generated text trimmed where a rule fired"""
+        return self.detok.text[:self.cut].strip()
+
+
+class StructureStop(StoppingCriteria):
+    """Per-row stop strings / house-style structure checks for one generate call.
+
+    Speculative decoding also calls this on proposed tokens that may be
+    rejected; a row whose seen tokens are no longer a prefix of input_ids
+    starts over from the tokens actually kept.
+    """
+
+    def __init__(self, rows, prompt_len):
+        self.rows = rows  # row index -> RowStops
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool)
+        for i, row in self.rows.items():
+            seen = self.prompt_len + len(row.detok.ids)
+            if row.detok.ids and input_ids[i, self.prompt_len:seen].tolist() != row.detok.ids:
+                row.reset()
+                seen = self.prompt_len
+            if input_ids.shape[1] > seen:
+                row.update(input_ids[i, seen:].tolist())
+            done[i] = row.done
+        return done
@@ -0,0 +1,129 @@
+import json, time
+import torch
+from transformers import TextIteratorStreamer
+
+from serve.batching import StageTimer, build_inputs, decoding_hooks, prepare_group, speculative_options
+from serve.telemetry import telemetry
+
+
+class TimedTextStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that timestamps every generated token as it arrives.
+
+    When `stops` (the row's RowStops) is set, text comes from the stop rules'
+    own decoding and is only passed on once no rule can cut it any more, so
+    the stream never runs past the trimmed answer.
+    """
+
+    def __init__(self, tok, **kwargs):
+        super().__init__(tok, skip_prompt=True, skip_special_tokens=True, **kwargs)
+        self.token_times = []
+        self.stops = None
+        self._ids = []
+        self._sent = 0
+
+    def put(self, value):
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            if self.stops is None:
+                return super().put(value)
+            self.next_tokens_are_prompt = False
+            return
+        # Speculative decoding can accept several tokens in one step
+        self.token_times.extend([time.perf_counter()] * value.shape[-1])
+        if self.stops is None:
+            return super().put(value)
+        self._ids.extend(value.reshape(-1).tolist())
+        # The rules run after this step's tokens arrive; until then they describe the
+        # previous step, unless they have been fed proposed tokens that were not kept
+        seen = self.stops.detok.ids
+        if seen == self._ids[:len(seen)]:
+            self._release(self.stops.settled())
+
+    def end(self):
+        if self.stops is None:
+            return super().end()
+        stops = self.stops
+        self._release(len(stops.text[:stops.cut].rstrip()))
+        self.next_tokens_are_prompt = True
+        self.on_finalized_text("", stream_end=True)
+
+    def _release(self, upto):
+        chunk = self.stops.text[self._sent:upto]
+        if not chunk:
+            return
+        if not self._sent:
+            chunk = chunk.lstrip()
+        self._sent = upto
+        if chunk:
+            self.on_finalized_text(chunk)
+
+
+def stream_generate(model, tok, job, streamer, prefix_cache=None, adapters=None, speculative=None):
+    """Run a single-prompt generate that pushes tokens into streamer.
+
+    Returns the trimmed text when stop strings or a content kind apply, else None.
+    """
+    try:
+        error = job.abandoned()
+        if error is not None:
+            raise error
+        started = time.perf_counter()
+        ids = tok(job.prompt)["input_ids"]
+        telemetry.observe_stage("tokenize", time.perf_counter() - started)
+        telemetry.count_prompt(len(ids))
+        prefix = prefix_cache.match(ids) if prefix_cache is not None else None
+        state, extra = prepare_group(model, 1, prefix, job.adapter, prefix_cache, adapters)
+        input_ids, attention_mask, past = build_inputs(tok, [ids], state)
+        if past is not None:
+            extra["past_key_values"] = past
+        spec = speculative_options([job], speculative)
+        extra.update(spec or {"do_sample": False})
+        processors, stops, structure = decoding_hooks(tok, [job], input_ids.shape[1], sample=spec is None)
+        streamer.stops = structure.get(0)
+        timer = StageTimer()
+        stops.append(timer)
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=job.max_tokens,
+                logits_processor=processors,
+                stopping_criteria=stops,
+                pad_token_id=tok.pad_token_id,
+                streamer=streamer,
+                **extra,
+            )
+        timer.finish(output.shape[1] - input_ids.shape[1])
+        telemetry.count_generated(int((output[0, input_ids.shape[1]:] != tok.pad_token_id).sum()))
+        error = job.abandoned()
+        if error is not None:
+            raise error
+        return streamer.stops.final_text() if streamer.stops is not None else None
+    finally:
+        # Always release the consumer, even if generate raised
+        streamer.end()
+
+
+def latency_summary(started, token_times):
+    """Time-to-first-token and inter-token latency (ms) from per-token timestamps"""
+    if not token_times:
+        return {"generated_tokens": 0, "ttft_ms": None, "itl_ms_mean": None, "itl_ms_p50": None,
+                "itl_ms_p95": None, "total_ms": round((time.perf_counter() - started) * 1000, 1)}
+    gaps = sorted((b - a) * 1000 for a, b in zip(token_times, token_times[1:]))
+
+    def pct(q):
+        return round(gaps[min(len(gaps) - 1, int(q * len(gaps)))], 2) if gaps else None
+
+    return {
+        "generated_tokens": len(token_times),
+        "ttft_ms": round((token_times[0] - started) * 1000, 1),
+        "itl_ms_mean": round(sum(gaps) / len(gaps), 2) if gaps else None,
+        "itl_ms_p50": pct(0.50),
+        "itl_ms_p95": pct(0.95),
+        "total_ms": round((token_times[-1] - started) * 1000, 1),
+    }
+
+
+def sse(data, event=None):
+    """Format one server-sent event"""
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
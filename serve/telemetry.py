@@ -0,0 +1,266 @@
+"""Low-overhead runtime metrics in the Prometheus text format.
+
+Counters and histograms are plain Python numbers behind a lock; updating one
+costs about a microsecond, so instrumentation stays on in production.
+Gauges are read from callbacks only when /metrics is scraped.
+
+With forked workers (serve/workers.py) every process keeps its own values.
+When a shared METRICS_DIR is set, each process writes a snapshot there every
+few seconds, and /metrics sums the counters and histograms of all workers,
+including ones that have since exited. Gauges are reported per live worker
+under a `pid` label.
+"""
+import os, json, time, bisect, threading
+from collections import deque
+
+# Stage latencies run from ~100µs (detokenising a short reply) to many seconds (queueing under load)
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Window for the rolling generated-tokens-per-second gauge
+RATE_WINDOW_S = 60.0
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _fmt(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+
+    def inc(self, amount=1, *label_values):
+        key = tuple(label_values)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+
+    def observe(self, value, *label_values):
+        key = tuple(label_values)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+
+class Telemetry:
+    """Metrics for the generation API; one shared instance per process (`telemetry` below)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_seconds = Histogram(
+            "wsl_stage_seconds", "Time per generation stage: queue_wait, tokenize, prefill, decode_per_token, detokenize",
+            STAGE_BUCKETS, ("stage",))
+        self.request_seconds = Histogram(
+            "wsl_request_seconds", "End-to-end request latency", REQUEST_BUCKETS, ("endpoint",))
+        self.requests = Counter("wsl_requests_total", "Generation requests served", ("endpoint", "cached"))
+        self.prompt_tokens = Counter("wsl_prompt_tokens_total", "Prompt tokens processed")
+        self.generated_tokens = Counter("wsl_generated_tokens_total", "Tokens generated")
+        self.rejected = Counter("wsl_rejected_total", "Requests turned away or abandoned: queue_full, deadline, disconnected",
+                                ("reason",))
+        self._counters = (self.requests, self.prompt_tokens, self.generated_tokens, self.rejected)
+        self._histograms = (self.stage_seconds, self.request_seconds)
+        self._gauges = {}
+        self._recent = deque()  # (time, generated tokens) inside RATE_WINDOW_S
+        self._decode_rate = 0.0
+        self._started = time.time()
+        self.directory = None
+        self._flusher_pid = None
+        self.gauge("process_resident_memory_bytes", "Resident memory of the serving process", process_rss_bytes)
+        self.gauge("wsl_generated_tokens_per_second", f"Generated tokens/s over the last {RATE_WINDOW_S:.0f}s",
+                   self._throughput)
+        self.gauge("wsl_decode_tokens_per_second", "Decode speed (tokens/s across the batch) of the last generate call",
+                   lambda: self._decode_rate)
+
+    # --- recording -------------------------------------------------------------------
+    def observe_stage(self, stage, seconds):
+        with self._lock:
+            self.stage_seconds.observe(seconds, stage)
+        self._ensure_flusher()
+
+    def observe_request(self, endpoint, seconds, cached=False):
+        with self._lock:
+            self.request_seconds.observe(seconds, endpoint)
+            self.requests.inc(1, endpoint, "true" if cached else "false")
+
+    def count_prompt(self, tokens):
+        with self._lock:
+            self.prompt_tokens.inc(tokens)
+
+    def count_generated(self, tokens):
+        with self._lock:
+            self.generated_tokens.inc(tokens)
+            self._recent.append((time.time(), tokens))
+
+    def count_rejected(self, reason):
+        with self._lock:
+            self.rejected.inc(1, reason)
+
+    def set_decode_rate(self, tokens_per_second):
+        self._decode_rate = tokens_per_second
+
+    def gauge(self, name, help, fn):
+        """Register a gauge whose value is read from fn() at scrape time"""
+        self._gauges[name] = (help, fn)
+
+    def _throughput(self):
+        now = time.time()
+        with self._lock:
+            while self._recent and self._recent[0][0] < now - RATE_WINDOW_S:
+                self._recent.popleft()
+            total = sum(n for _, n in self._recent)
+        return total / min(RATE_WINDOW_S, max(now - self._started, 1.0))
+
+    # --- export ----------------------------------------------------------------------
+    def snapshot(self):
+        """This process's values as plain JSON-able data"""
+        with self._lock:
+            snap = {
+                "counters": {c.name: [[list(k), v] for k, v in c.values.items()] for c in self._counters},
+                "histograms": {h.name: [[list(k), [list(e[0]), e[1], e[2]]] for k, e in h.values.items()]
+                               for h in self._histograms},
+            }
+        gauges = {}
+        for name, (_, fn) in self._gauges.items():
+            try:
+                gauges[name] = float(fn())
+            except Exception:
+                continue  # a failing gauge must not break the scrape
+        snap["gauges"] = gauges
+        return snap
+
+    def share(self, directory, interval=5.0):
+        """Write snapshots to directory (shared by all workers) so /metrics can aggregate them"""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+
+    def _ensure_flusher(self):
+        # Threads don't survive fork, so each worker starts its own on first use
+        if self.directory is None or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def flush(self):
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def _snapshots(self):
+        """{pid: snapshot} for this process and, when sharing, every worker that has written one"""
+        own = self.snapshot()
+        if self.directory is None:
+            return {os.getpid(): own}
+        self._ensure_flusher()
+        snaps = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snaps[int(name[:-5])] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        snaps[os.getpid()] = own
+        return snaps
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        snaps = self._snapshots()
+        per_worker = self.directory is not None
+        out = []
+        for c in self._counters:
+            totals = {}
+            for snap in snaps.values():
+                for key, value in snap["counters"].get(c.name, []):
+                    totals[tuple(key)] = totals.get(tuple(key), 0) + value
+            out += [f"# HELP {c.name} {c.help}", f"# TYPE {c.name} counter"]
+            if not totals and not c.labels:
+                totals[()] = 0
+            for key, value in sorted(totals.items()):
+                out.append(f"{c.name}{_labels(c.labels, key)} {_fmt(value)}")
+
+        for h in self._histograms:
+            totals = {}
+            for snap in snaps.values():
+                for key, (counts, total, n) in snap["histograms"].get(h.name, []):
+                    entry = totals.setdefault(tuple(key), [[0] * len(counts), 0.0, 0])
+                    entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                    entry[1] += total
+                    entry[2] += n
+            out += [f"# HELP {h.name} {h.help}", f"# TYPE {h.name} histogram"]
+            for key, (counts, total, n) in sorted(totals.items()):
+                running = 0
+                for bound, count in zip(h.buckets + (float("inf"),), counts):
+                    running += count
+                    out.append(f"{h.name}_bucket{_labels(h.labels + ('le',), key + (_fmt(bound),))} {running}")
+                out.append(f"{h.name}_sum{_labels(h.labels, key)} {_fmt(total)}")
+                out.append(f"{h.name}_count{_labels(h.labels, key)} {n}")
+
+        live = {pid: snap for pid, snap in snaps.items() if pid == os.getpid() or _alive(pid)}
+        for name, (help, _) in self._gauges.items():
+            out += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            for pid, snap in sorted(live.items()):
+                if name in snap["gauges"]:
+                    labels = _labels(("pid",), (pid,)) if per_worker else ""
+                    out.append(f"{name}{labels} {_fmt(snap['gauges'][name])}")
+        return "\n".join(out) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def process_rss_bytes():
+    """Current resident set size of this process"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource, sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+telemetry = Telemetry()
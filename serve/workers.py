@@ -0,0 +1,117 @@
+"""Pre-fork launcher: load the model once, then fork uvicorn workers that share it.
+
+`uvicorn --workers N` imports serve.app in N fresh processes, so each one
+loads its own copy of the weights. Here the parent loads the model (mmap'd
+from the merged checkpoint when present) and binds the port. It then forks.
+Children read the same physical weight pages copy-on-write and only
+allocate their own activations and KV caches.
+
+    python -m serve.workers --workers 4 --port 8000
+"""
+import os, sys, signal, socket, argparse, tempfile, time
+
+# Add parent directory to path so we can import serve.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def available_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def run_worker(app, sock, index, workers, cores, pin):
+    """Body of a forked worker: claim a core slice, then serve on the shared socket"""
+    import torch
+    import uvicorn
+
+    per_worker = max(1, len(cores) // workers)
+    if pin and len(cores) >= workers and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores[index * per_worker:(index + 1) * per_worker])
+    torch.set_num_threads(per_worker)
+
+    config = uvicorn.Config(app, log_level=os.getenv("LOG_LEVEL", "info"))
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def main():
+    p = argparse.ArgumentParser(description="Serve the API from several forked workers sharing one model")
+    p.add_argument("--workers", type=int, default=int(os.getenv("SERVE_WORKERS", "2")))
+    p.add_argument("--host", default="0.0.0.0")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--no-pin", action="store_true", help="don't pin workers to disjoint core sets")
+    args = p.parse_args()
+
+    # Keep torch single-threaded until after fork: an OpenMP pool started in
+    # the parent is not safe to inherit
+    import torch
+    torch.set_num_threads(1)
+
+    # Each worker keeps its own metrics; /metrics sums the snapshots they write here
+    metrics_dir = os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="wsl-metrics-"))
+    os.makedirs(metrics_dir, exist_ok=True)
+    for name in os.listdir(metrics_dir):
+        if name.endswith((".json", ".tmp")):
+            os.remove(os.path.join(metrics_dir, name))  # counters from a previous run
+
+    from serve.app import ServingState, create_app
+
+    # Load tokenizer + weights once, in the parent, so workers are ready as soon as they fork
+    app = create_app(ServingState().load())
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    cores = available_cores()
+    print(f"Forking {args.workers} workers on {args.host}:{args.port} "
+          f"({max(1, len(cores) // args.workers)} threads each)")
+
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(app, sock, index, args.workers, cores, not args.no_pin)
+            finally:
+                os._exit(0)
+        children[pid] = index
+
+    for i in range(args.workers):
+        spawn(i)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Reap workers; replace any that die while we're still serving
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"Worker {index} (pid {pid}) exited with status {status}; restarting")
+            time.sleep(1)
+            spawn(index)
+
+
+if __name__ == "__main__":
+    main()
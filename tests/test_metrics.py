@@ -0,0 +1,32 @@
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eval.metrics import METRICS, score_batch, score_example
+
+EXAMPLES = [
+    {"nums": [12, 5]},
+    {"nums": [12, 5], "expects_json": True},
+    {"unsafe": True},
+    {"expects_bullets": True, "expects_hashtags": True},
+    {"expects_bullets": True, "expects_hashtags": False},
+]
+OUTPUTS = [
+    "Arsenal created 12 shots, 5 on target.",
+    '{"shots": 12, "on_target": 4}',
+    "Sorry, but I can't help with that.",
+    "1️⃣ Pressing up\n2️⃣ Rotation steady #WSL",
+    "No bullets here.",
+]
+
+
+def test_score_batch_matches_score_example():
+    scores = score_batch(EXAMPLES, OUTPUTS)
+    assert scores.shape == (len(EXAMPLES), len(METRICS))
+    for row, ex, out in zip(scores, EXAMPLES, OUTPUTS):
+        single = score_example(ex, out)
+        assert [single[m] for m in METRICS] == row.tolist()
+        assert single["avg"] == sum(row.tolist()) / len(METRICS)
+    # The rows above exercise passes and failures
+    assert scores[1, METRICS.index("facts")] == 0.0
+    assert scores[4, METRICS.index("bullets")] == 0.0
@@ -0,0 +1,27 @@
+import os, sys, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from serve.admission import QueueFull
+from serve.batching import BatchScheduler, GenerationJob
+
+
+def test_exclusive_work_skips_admission_accounting():
+    scheduler = BatchScheduler(lambda jobs: [{} for _ in jobs], max_queue=1)
+    release = threading.Event()
+    blocker = scheduler.run_exclusive(release.wait)
+    try:
+        queued = scheduler.submit(GenerationJob(prompt="a"))
+        # The queue is full for jobs, but exclusive work still goes in and isn't counted
+        extra = scheduler.run_exclusive(lambda: "done")
+        assert scheduler.depth() == 1
+        with pytest.raises(QueueFull):
+            scheduler.submit(GenerationJob(prompt="b"))
+    finally:
+        release.set()
+    blocker.result(timeout=5)
+    assert queued.result(timeout=5) == {}
+    assert extra.result(timeout=5) == "done"
+    assert scheduler.depth() == 0
@@ -0,0 +1,80 @@
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from serve.stopping import RowStops
+from serve.streaming import TimedTextStreamer
+
+
+class CharTokenizer:
+    """One token per character, so tests can say exactly what was generated"""
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, ids, **kwargs):
+        return "".join(chr(i) for i in ids)
+
+
+def run(text, **kwargs):
+    """Feed text one token at a time, as generate would, until a rule fires"""
+    tok = CharTokenizer()
+    stops = RowStops(tok, **kwargs)
+    for i in tok.encode(text):
+        if stops.update([i]):
+            break
+    return stops
+
+
+def test_preview_closes_on_hashtags_after_the_verdict():
+    text = ("1. Arsenal press high #WSL\n2. Chelsea concede from corners\n"
+            "Data Verdict: a narrow lean to Arsenal.\n#WSL #WSLAnalytics\nExtra chatter")
+    stops = run(text, kind="preview")
+    assert stops.done
+    assert stops.final_text().endswith("Arsenal.\n#WSL #WSLAnalytics")
+
+
+def test_recap_closes_on_a_verdict_line_ending_in_hashtags():
+    text = "1. City won the xG battle\nData Verdict: the result matched the numbers #WSL\nMore"
+    stops = run(text, kind="recap")
+    assert stops.done
+    assert stops.final_text().endswith("the numbers #WSL")
+
+
+def test_thread_closes_on_hashtags_after_its_bullets():
+    text = ("This week's thread #WSL\n1️⃣ United climb to #3\n2️⃣ Spurs leak late goals\n"
+            "Form is fragile at the top. #WSL #WSLAnalytics\nAnd another line")
+    stops = run(text, kind="thread")
+    assert stops.done
+    assert stops.final_text().startswith("This week's thread #WSL\n1️⃣")
+    assert stops.final_text().endswith("fragile at the top. #WSL #WSLAnalytics")
+
+
+def test_caption_closes_on_its_first_hashtag_line():
+    text = "Villa's press forced 12 turnovers. Home form holds. #WSL\nA second paragraph"
+    stops = run(text, kind="caption")
+    assert stops.done
+    assert stops.final_text() == "Villa's press forced 12 turnovers. Home form holds. #WSL"
+
+
+def test_preview_hashtags_before_the_verdict_do_not_close():
+    stops = run("1. Arsenal press high #WSL\n2. Chelsea concede from corners\n", kind="preview")
+    assert not stops.done
+
+
+def test_stream_stops_at_the_trimmed_text():
+    text = "Alpha beta gamma STOP delta"
+    tok = CharTokenizer()
+    streamer = TimedTextStreamer(tok)
+    streamer.stops = stops = RowStops(tok, stop=["STOP"])
+    streamer.put(torch.tensor([[1, 2, 3]]))  # the prompt
+    # generate hands each step's tokens to the streamer, then runs the stopping criteria
+    for i in tok.encode(text):
+        streamer.put(torch.tensor([[i]]))
+        if stops.update([i]):
+            break
+    streamer.end()
+    chunks = list(streamer)
+    assert "".join(chunks) == stops.final_text() == "Alpha beta gamma"
@@ -0,0 +1,78 @@
+import asyncio, json, os, sys, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serve.streaming
+from serve.app import ServingState, create_app
+from serve.batching import BatchScheduler
+
+
+class StubTokenizer:
+    """Enough of a tokenizer for TimedTextStreamer, which only decodes what it is given"""
+
+    def decode(self, ids, **kwargs):
+        return ""
+
+
+def ready_state():
+    state = ServingState()
+    state.status = "ready"
+    state.tok, state.model, state.adapters = StubTokenizer(), None, None
+    state.prefix_cache, state.speculative, state.response_cache = None, None, None
+    state.scheduler = BatchScheduler(lambda jobs: [{} for _ in jobs])
+    return state
+
+
+async def stream_then_disconnect(app, body):
+    """POST /generate/stream, then disconnect before any event arrives"""
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    disconnect = asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": "/generate/stream", "raw_path": b"/generate/stream", "query_string": b"",
+             "root_path": "", "headers": [(b"content-type", b"application/json")],
+             "client": ("test", 1), "server": ("test", 80)}
+    task = asyncio.create_task(app(scope, receive, send))
+    await asyncio.sleep(0.3)
+    disconnect.set()
+    await asyncio.wait_for(task, timeout=5)
+
+
+def test_disconnect_while_queued_releases_stream_reader(monkeypatch):
+    ran = []
+    monkeypatch.setattr(serve.streaming, "stream_generate", lambda *args, **kwargs: ran.append(args))
+    state = ready_state()
+    app = create_app(state)
+
+    # Keep the model thread busy so the stream job is still queued when the client leaves
+    release = threading.Event()
+    blocker = state.scheduler.run_exclusive(release.wait)
+    body = json.dumps({"prompt": "hi", "max_tokens": 5}).encode()
+
+    # asyncio.run joins the default executor on exit, so it only returns once
+    # the thread reading the streamer has been released
+    finished = threading.Event()
+
+    def client():
+        asyncio.run(stream_then_disconnect(app, body))
+        finished.set()
+
+    threading.Thread(target=client, daemon=True).start()
+    try:
+        assert finished.wait(5), "the thread reading the streamer is still blocked"
+    finally:
+        release.set()
+        blocker.result(timeout=5)
+
+    # Jobs run in order, so once this has run the cancelled stream job has been passed over
+    state.scheduler.run_exclusive(lambda: None).result(timeout=5)
+    assert ran == []
@@ -0,0 +1,42 @@
+import os, sys, torch
+
+# Add parent directory to path so we can import train.utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peft import PeftModel
+from transformers import AutoModelForCausalLM
+from train.utils import tokenizer_for, get_env
+
+# Load configuration from .env
+BASE = get_env("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+OUT  = get_env("OUT_DIR", "artifacts/sft")
+MERGED = get_env("MERGED_DIR", "artifacts/merged")
+
+print("="*60)
+print("MERGING ADAPTER...")
+print("="*60)
+
+# Load base model and trained adapter
+base = AutoModelForCausalLM.from_pretrained(
+    BASE,
+    torch_dtype=torch.float32,
+    device_map="cpu"
+)
+model = PeftModel.from_pretrained(base, OUT)
+
+# Fold the LoRA deltas into q/k/v/o_proj and drop the adapter wrappers
+merged = model.merge_and_unload()
+print(f"Base: {BASE}")
+print(f"Adapter: {OUT}")
+print(f"Parameters: {merged.num_parameters():,}")
+
+print("\n" + "="*60)
+print("SAVING MERGED CHECKPOINT...")
+print("="*60)
+
+# One unsharded safetensors file so the server can memory-map it directly
+merged.save_pretrained(MERGED, safe_serialization=True, max_shard_size="100GB")
+tokenizer_for(BASE).save_pretrained(MERGED)
+
+print(f"✅ Merged model saved to: {MERGED}")
+print("="*60)
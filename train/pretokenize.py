@@ -0,0 +1,25 @@
+import os, sys, argparse
+
+# Add parent directory to path so we can import train.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from train.utils import tokenizer_for, get_env
+from train.token_cache import load_or_build
+
+p = argparse.ArgumentParser(description="Tokenise SFT splits once into memory-mapped caches")
+p.add_argument("--inputs", nargs="+", default=[
+    get_env("TRAIN_JSONL", "data/processed/sft_train.jsonl"),
+    get_env("VAL_JSONL", "data/processed/sft_val.jsonl"),
+])
+p.add_argument("--cache_dir", default=get_env("TOKEN_CACHE_DIR", "data/cache/tokenized"))
+args = p.parse_args()
+
+BASE = get_env("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+MAX_IN  = int(get_env("MAX_INPUT_TOKENS", "1024"))
+MAX_OUT = int(get_env("MAX_TARGET_TOKENS", "384"))
+
+tok = tokenizer_for(BASE)
+for path in args.inputs:
+    ds, cache, built = load_or_build(path, tok, MAX_IN, MAX_OUT, args.cache_dir)
+    print(f"{'Built' if built else 'Cached'}: {path} -> {cache} "
+          f"({len(ds)} examples, {sum(ds.lengths):,} tokens)")
@@ -4,131 +4,240 @@ import os, sys, torch
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from peft import LoraConfig, get_peft_model, TaskType
-from transformers import AutoModelForCausalLM, TrainingArguments, Trainer, DataCollatorForLanguageModeling
-from train.utils import tokenizer_for, load_jsonl, format_pair_fn, get_env
+from transformers import AutoModelForCausalLM, TrainingArguments
+from train.token_cache import load_or_build
+from train.utils import (
+    tokenizer_for, load_jsonl, format_pair_fn, get_env,
+    PaddingCollator, PackedCollator, PackedDataset, TokenBudgetBatchSampler, BatchSamplerTrainer
+)
 
 # Load configuration from .env
 BASE = get_env("BASE_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
 OUT  = get_env("OUT_DIR", "artifacts/sft")
 MAX_IN  = int(get_env("MAX_INPUT_TOKENS", "1024"))
 MAX_OUT = int(get_env("MAX_TARGET_TOKENS", "384"))
-
-print("="*60)
-print("LOADING DATA...")
-print("="*60)
-
-# Load training and validation datasets
-ds_tr = load_jsonl("data/processed/sft_train.jsonl")
-ds_va = load_jsonl("data/processed/sft_val.jsonl")
-print(f"Train examples: {len(ds_tr)}")
-print(f"Val examples: {len(ds_va)}")
-
-print("\n" + "="*60)
-print("LOADING TOKENIZER...")
-print("="*60)
-
-# Load tokenizer
-tok = tokenizer_for(BASE)
-print(f"Vocab size: {len(tok)}")
-
-print("\n" + "="*60)
-print("FORMATTING DATA...")
-print("="*60)
-
-# Format data for training
-fmt = format_pair_fn(tok, MAX_IN, MAX_OUT)
-ds_tr = ds_tr.map(fmt, remove_columns=ds_tr.column_names)
-ds_va = ds_va.map(fmt, remove_columns=ds_va.column_names)
-print("Data formatted!")
-
-print("\n" + "="*60)
-print("LOADING BASE MODEL...")
-print("="*60)
-
-# Load base model
-model = AutoModelForCausalLM.from_pretrained(
-    BASE, 
-    torch_dtype=torch.float32,  # CPU requires float32
-    device_map="cpu"
-)
-print(f"Model loaded: {BASE}")
-print(f"Parameters: {model.num_parameters():,}")
-
-print("\n" + "="*60)
-print("ADDING LORA ADAPTERS...")
-print("="*60)
-
-# Configure LoRA
-peft_cfg = LoraConfig(
-    r=8,                    # LoRA rank
-    lora_alpha=16,          # LoRA scaling factor
-    lora_dropout=0.05,      # Dropout for regularization
-    bias="none",            # Don't adapt bias terms
-    task_type=TaskType.CAUSAL_LM,
-    target_modules=["q_proj", "k_proj", "v_proj", "o_proj"]
-)
-
-# Add LoRA to model
-model = get_peft_model(model, peft_cfg)
-trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
-print(f"Trainable parameters: {trainable_params:,}")
-print(f"Percentage trainable: {100 * trainable_params / model.num_parameters():.2f}%")
-
-print("\n" + "="*60)
-print("CONFIGURING TRAINING...")
-print("="*60)
-
-# Training configuration
-args = TrainingArguments(
-    output_dir=OUT,
-    num_train_epochs=1,
-    per_device_train_batch_size=1,
-    gradient_accumulation_steps=16,
-    eval_strategy="steps",              # ← FIXED: was evaluation_strategy
-    eval_steps=100,
-    save_steps=100,
-    learning_rate=2e-4,
-    lr_scheduler_type="cosine",
-    warmup_ratio=0.05,
-    logging_steps=20,
-    bf16=False,
-    fp16=False,
-    save_total_limit=2,
-    report_to="none"
-)
-
-print("Training config:")
-print(f"  Epochs: {args.num_train_epochs}")
-print(f"  Batch size: {args.per_device_train_batch_size}")
-print(f"  Gradient accumulation: {args.gradient_accumulation_steps}")
-print(f"  Learning rate: {args.learning_rate}")
-
-# Data collator
-collator = DataCollatorForLanguageModeling(tok, mlm=False)
-
-print("\n" + "="*60)
-print("STARTING TRAINING...")
-print("="*60)
-
-# Create trainer
-trainer = Trainer(
-    model=model,
-    args=args,
-    train_dataset=ds_tr,
-    eval_dataset=ds_va,
-    data_collator=collator
-)
-
-# Train!
-trainer.train()
-
-print("\n" + "="*60)
-print("SAVING MODEL...")
-print("="*60)
-
-# Save the fine-tuned adapter
-trainer.save_model(OUT)
-tok.save_pretrained(OUT)
-
-print(f"✅ SFT adapter saved to: {OUT}")
-print("="*60)
+TRAIN_JSONL = get_env("TRAIN_JSONL", "data/processed/sft_train.jsonl")
+VAL_JSONL = get_env("VAL_JSONL", "data/processed/sft_val.jsonl")
+TOKEN_CACHE = get_env("TOKEN_CACHE", "1") == "1"
+TOKEN_CACHE_DIR = get_env("TOKEN_CACHE_DIR", "data/cache/tokenized")
+TOKENS_PER_BATCH = int(get_env("TOKENS_PER_BATCH", "4096"))  # 0 = one example per batch
+GRAD_ACCUM = get_env("GRAD_ACCUM_STEPS")
+PACKING = get_env("PACKING", "0") == "1"
+PACK_BLOCK_SIZE = int(get_env("PACK_BLOCK_SIZE", str(MAX_IN + MAX_OUT)))
+SEED = int(get_env("SEED", "42"))
+METRICS_OUT = get_env("TRAIN_METRICS_OUT")  # optional JSON file for the run's throughput numbers
+
+# LoRA adapter settings (train/sweep.py varies these per trial)
+LORA_DEFAULTS = {
+    "r": 8,                 # LoRA rank
+    "lora_alpha": 16,       # LoRA scaling factor
+    "lora_dropout": 0.05,   # Dropout for regularization
+    "target_modules": ["q_proj", "k_proj", "v_proj", "o_proj"],
+}
+
+# Optimiser/schedule settings passed to TrainingArguments
+TRAIN_DEFAULTS = {
+    "num_train_epochs": 1,
+    "max_steps": -1,        # > 0 overrides the epoch count
+    "learning_rate": 2e-4,
+    "lr_scheduler_type": "cosine",
+    "warmup_ratio": 0.05,
+    "weight_decay": 0.0,
+    "eval_steps": 100,
+    "save_steps": 100,
+    "logging_steps": 20,
+}
+
+
+def banner(title):
+    print("\n" + "="*60)
+    print(title)
+    print("="*60)
+
+
+def load_splits(tok, train_jsonl=TRAIN_JSONL, val_jsonl=VAL_JSONL, token_cache=TOKEN_CACHE):
+    """Tokenised train and validation splits (memory-mapped from the token cache when enabled)"""
+    if token_cache:
+        # Memory-mapped token arrays, built once per data/tokenizer/length-limit fingerprint
+        ds_tr, cache_tr, built_tr = load_or_build(train_jsonl, tok, MAX_IN, MAX_OUT, TOKEN_CACHE_DIR)
+        ds_va, cache_va, built_va = load_or_build(val_jsonl, tok, MAX_IN, MAX_OUT, TOKEN_CACHE_DIR)
+        print(f"Token cache: {cache_tr} ({'built' if built_tr else 'hit'})")
+        print(f"Token cache: {cache_va} ({'built' if built_va else 'hit'})")
+    else:
+        # Load training and validation datasets, then format them
+        ds_tr = load_jsonl(train_jsonl)
+        ds_va = load_jsonl(val_jsonl)
+        fmt = format_pair_fn(tok, MAX_IN, MAX_OUT)
+        ds_tr = ds_tr.map(fmt, remove_columns=ds_tr.column_names)
+        ds_va = ds_va.map(fmt, remove_columns=ds_va.column_names)
+        print("Data formatted!")
+    print(f"Train examples: {len(ds_tr)}")
+    print(f"Val examples: {len(ds_va)}")
+    return ds_tr, ds_va
+
+
+def example_lengths(ds):
+    return list(ds.lengths) if hasattr(ds, "lengths") else [len(x) for x in ds["input_ids"]]
+
+
+def build_model(base=BASE, lora=None):
+    """Base model with LoRA adapters added (LORA_DEFAULTS overridden by lora)"""
+    banner("LOADING BASE MODEL...")
+
+    # Load base model
+    model = AutoModelForCausalLM.from_pretrained(
+        base,
+        torch_dtype=torch.float32,  # CPU requires float32
+        device_map="cpu"
+    )
+    print(f"Model loaded: {base}")
+    print(f"Parameters: {model.num_parameters():,}")
+
+    banner("ADDING LORA ADAPTERS...")
+
+    # Configure LoRA
+    peft_cfg = LoraConfig(
+        bias="none",            # Don't adapt bias terms
+        task_type=TaskType.CAUSAL_LM,
+        **{**LORA_DEFAULTS, **(lora or {})}
+    )
+
+    # Add LoRA to model
+    model = get_peft_model(model, peft_cfg)
+    trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    print(f"Trainable parameters: {trainable_params:,}")
+    print(f"Percentage trainable: {100 * trainable_params / model.num_parameters():.2f}%")
+    return model
+
+
+def train(tok, ds_tr, ds_va, out_dir=OUT, base=BASE, lora=None, train_cfg=None, packing=PACKING,
+          tokens_per_batch=TOKENS_PER_BATCH, grad_accum=GRAD_ACCUM, seed=SEED, callbacks=None, **args_overrides):
+    """Fine-tune LoRA adapters on the base model; returns (trainer, throughput metrics).
+
+    train_cfg overrides TRAIN_DEFAULTS and args_overrides go straight to
+    TrainingArguments. The adapter isn't saved here; see `trainer.save_model`.
+    """
+    n_train = len(ds_tr)
+    lengths = example_lengths(ds_tr)
+    train_tokens = sum(lengths)
+
+    # Optionally pack several short examples into each fixed-size block
+    if packing:
+        ds_tr = PackedDataset(ds_tr, lengths, PACK_BLOCK_SIZE)
+        ds_va = PackedDataset(ds_va, example_lengths(ds_va), PACK_BLOCK_SIZE)
+        lengths = ds_tr.lengths
+        print(f"Packed {n_train} examples into {len(ds_tr)} blocks of <= {PACK_BLOCK_SIZE} tokens "
+              f"({100 * train_tokens / (len(ds_tr) * PACK_BLOCK_SIZE):.1f}% full)")
+
+    # Batch examples of similar length up to a token budget instead of one at a time
+    batch_sampler = None
+    if tokens_per_batch > 0:
+        batch_sampler = TokenBudgetBatchSampler(lengths, tokens_per_batch, seed=seed)
+        print(f"Length-grouped batches: {len(batch_sampler)} "
+              f"(mean {batch_sampler.mean_batch_size():.1f} {'blocks' if packing else 'examples'}, "
+              f"budget {tokens_per_batch} tokens)")
+
+    # Keep ~16 examples per optimiser step unless told otherwise
+    examples_per_batch = n_train / (len(batch_sampler) if batch_sampler else len(ds_tr))
+    if grad_accum:
+        grad_accum = int(grad_accum)
+    else:
+        grad_accum = max(1, round(16 / examples_per_batch))
+
+    model = build_model(base, lora)
+
+    banner("CONFIGURING TRAINING...")
+
+    # Training configuration
+    cfg = {**TRAIN_DEFAULTS, **(train_cfg or {})}
+    args = TrainingArguments(**{
+        "output_dir": out_dir,
+        "per_device_train_batch_size": 1,
+        "gradient_accumulation_steps": grad_accum,
+        "eval_strategy": "steps",           # ← FIXED: was evaluation_strategy
+        "bf16": False,
+        "fp16": False,
+        "save_total_limit": 2,
+        "report_to": "none",
+        "seed": seed,
+        "remove_unused_columns": False,     # collators build exactly the model inputs
+        **cfg,
+        **args_overrides,
+    })
+
+    print("Training config:")
+    print(f"  Epochs: {args.num_train_epochs}" + (f" (max {args.max_steps} steps)" if args.max_steps > 0 else ""))
+    print(f"  Batch size: {f'<= {tokens_per_batch} tokens' if batch_sampler else args.per_device_train_batch_size}")
+    print(f"  Packing: {'on' if packing else 'off'}")
+    print(f"  Gradient accumulation: {args.gradient_accumulation_steps}")
+    print(f"  Learning rate: {args.learning_rate}")
+
+    # Data collator: pads per batch and keeps the -100 prompt masking from format_pair_fn
+    # (packed blocks also get a block-diagonal attention mask)
+    collator = PackedCollator(tok.pad_token_id) if packing else PaddingCollator(tok.pad_token_id)
+
+    banner("STARTING TRAINING...")
+
+    # Create trainer
+    trainer = BatchSamplerTrainer(
+        model=model,
+        args=args,
+        train_dataset=ds_tr,
+        eval_dataset=ds_va,
+        data_collator=collator,
+        train_batch_sampler=batch_sampler,
+        callbacks=callbacks
+    )
+
+    # Train!
+    result = trainer.train()
+
+    # Throughput over real (non-padding) tokens, comparable across batching modes
+    runtime = result.metrics["train_runtime"]
+    epochs = trainer.state.epoch or args.num_train_epochs
+    tokens_per_sec = train_tokens * epochs / runtime
+    print(f"Training throughput: {tokens_per_sec:,.0f} tokens/sec ({runtime:.1f}s)")
+
+    return trainer, {
+        "train_runtime_s": runtime,
+        "steps": result.global_step,
+        "steps_per_s": result.global_step / runtime,
+        "examples_per_s": n_train * epochs / runtime,
+        "tokens_per_s": tokens_per_sec,
+        "train_tokens": train_tokens,
+        "grad_accum": grad_accum,
+    }
+
+
+def main():
+    print("="*60)
+    print("LOADING TOKENIZER...")
+    print("="*60)
+
+    # Load tokenizer
+    tok = tokenizer_for(BASE)
+    print(f"Vocab size: {len(tok)}")
+
+    banner("LOADING DATA...")
+    ds_tr, ds_va = load_splits(tok)
+
+    trainer, metrics = train(tok, ds_tr, ds_va)
+
+    if METRICS_OUT:
+        import json
+        os.makedirs(os.path.dirname(os.path.abspath(METRICS_OUT)), exist_ok=True)
+        with open(METRICS_OUT, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+    banner("SAVING MODEL...")
+
+    # Save the fine-tuned adapter
+    trainer.save_model(OUT)
+    tok.save_pretrained(OUT)
+
+    print(f"✅ SFT adapter saved to: {OUT}")
+    print("="*60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""Parallel hyperparameter sweep over LoRA training runs.
+
+Trials run in separate processes, each pinned to its own slice of cores with
+torch limited to that many threads, so a many-core box runs several small
+trainings side by side instead of one that can't use all its cores. The data
+is tokenised once into the token cache and memory-mapped by every trial.
+
+Trials report eval loss as they train. A trial whose best loss so far is
+worse than the median of the other trials at the same point in training
+(same epoch fraction) is stopped early. Every trial's settings, throughput
+and loss go to results.jsonl and results.csv under --out_dir.
+
+    python train/sweep.py --spec train/sweeps/lora.json --cores_per_trial 4
+
+The spec is JSON: "method" is "grid" (every combination of the listed
+values) or "random" ("trials" draws, seeded by "seed"; a param is either a
+list to choose from or {"low", "high", "log", "int"}). "params" holds the
+swept settings and "fixed" holds settings shared by every trial. Keys are
+LoRA settings (r, lora_alpha, lora_dropout, target_modules), training
+settings (learning_rate, max_steps, eval_steps, ...) or packing,
+tokens_per_batch, grad_accum and seed.
+"""
+import os, sys, csv, json, math, time, random, argparse, itertools, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+
+# Add parent directory to path so we can import train.*
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import TrainerCallback
+from train.sft_lora_cpu import BASE, LORA_DEFAULTS, TRAIN_DEFAULTS, load_splits, train
+from train.token_cache import TokenizedDataset
+from train.utils import tokenizer_for
+
+# Sweepable settings that aren't LoRA or TrainingArguments fields
+RUN_KEYS = ("packing", "tokens_per_batch", "grad_accum", "seed")
+
+
+def available_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def split_params(params):
+    """(lora, train_cfg, run kwargs) from one trial's flat settings"""
+    lora, train_cfg, run = {}, {}, {}
+    for key, value in params.items():
+        if key in LORA_DEFAULTS:
+            lora[key] = value
+        elif key in RUN_KEYS:
+            run[key] = value
+        else:
+            train_cfg[key] = value
+    return lora, train_cfg, run
+
+
+def sample(dist, rng):
+    if isinstance(dist, list):
+        return rng.choice(dist)
+    if isinstance(dist, dict):
+        low, high = dist["low"], dist["high"]
+        if dist.get("log"):
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            value = rng.uniform(low, high)
+        return int(round(value)) if dist.get("int") else value
+    return dist
+
+
+def trials_from_spec(spec):
+    """Every trial's settings (fixed merged with swept) for a grid or random spec"""
+    method = spec.get("method", "grid")
+    params, fixed = spec.get("params", {}), spec.get("fixed", {})
+    from transformers import TrainingArguments
+    known = set(LORA_DEFAULTS) | set(TRAIN_DEFAULTS) | set(RUN_KEYS) | set(TrainingArguments.__dataclass_fields__)
+    unknown = sorted((set(params) | set(fixed)) - known)
+    if unknown:
+        raise ValueError(f"Unknown sweep settings: {', '.join(unknown)}")
+
+    if method == "grid":
+        names = list(params)
+        grids = []
+        for name in names:
+            values = params[name]
+            if isinstance(values, dict):
+                raise ValueError(f"Grid param {name} needs a list of values, not a range")
+            grids.append(values if isinstance(values, list) else [values])
+        return [{**fixed, **dict(zip(names, combo))} for combo in itertools.product(*grids)]
+    if method == "random":
+        rng = random.Random(spec.get("seed", 0))
+        return [{**fixed, **{name: sample(dist, rng) for name, dist in params.items()}}
+                for _ in range(int(spec.get("trials", 10)))]
+    raise ValueError(f"Unsupported sweep method: {method!r} (expected 'grid' or 'random')")
+
+
+class MedianPruner(TrainerCallback):
+    """Stop a trial whose eval loss trails the median of the other trials at the same epoch.
+
+    Each trial writes its (epoch, eval loss) history to reports_dir, shared by
+    all trial processes. Pruning only starts after warmup_evals evaluations,
+    and only against trials that have trained at least as far as this one.
+    Other trials count if they are still running, finished or pruned
+    themselves.
+    """
+
+    def __init__(self, reports_dir, trial, warmup_evals=1, min_trials=3):
+        self.reports_dir, self.trial = reports_dir, trial
+        self.warmup_evals, self.min_trials = warmup_evals, min_trials
+        self.history = []  # [epoch, eval loss]
+        self.pruned_at = None
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        loss = (metrics or {}).get("eval_loss")
+        if loss is None:
+            return
+        epoch = state.epoch or 0.0
+        self.record(epoch, loss)
+        if len(self.history) <= self.warmup_evals:
+            return
+        others = []
+        for name in os.listdir(self.reports_dir):
+            if not name.endswith(".json") or name == f"{self.trial}.json":
+                continue
+            try:
+                with open(os.path.join(self.reports_dir, name)) as f:
+                    history = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # Only trials that have trained at least as far as this one
+            if history and history[-1][0] >= epoch * 0.95:
+                best = min((l for e, l in history if e <= epoch * 1.05), default=None)
+                if best is not None:
+                    others.append(best)
+        if len(others) < self.min_trials:
+            return
+        others.sort()
+        mid = len(others) // 2
+        median = others[mid] if len(others) % 2 else (others[mid - 1] + others[mid]) / 2
+        best = min(l for _, l in self.history)
+        if best > median:
+            self.pruned_at = epoch
+            control.should_training_stop = True
+
+    def record(self, epoch, loss):
+        self.history.append([epoch, loss])
+        path = os.path.join(self.reports_dir, f"{self.trial}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.history, f)
+        os.replace(path + ".tmp", path)
+
+
+def _init_worker(slots):
+    """Claim a core slice for this worker process and size torch's thread pool to it"""
+    import torch
+
+    cores = slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def run_trial(trial, params, shared):
+    """Train one configuration; returns its row of the results table"""
+    import torch
+
+    log_path = os.path.join(shared["out_dir"], "logs", f"trial-{trial:03d}.log")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(log_path, "w") as log:
+        # Trainer and tqdm output goes to the trial's own log
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+
+    row = {"trial": trial, "status": "failed", "params": params, "threads": torch.get_num_threads(),
+           "log": log_path}
+    started = time.perf_counter()
+    try:
+        tok = tokenizer_for(shared["base"])
+        ds_tr, ds_va = TokenizedDataset(shared["train_cache"]), TokenizedDataset(shared["val_cache"])
+        pruner = MedianPruner(shared["reports_dir"], trial, shared["warmup_evals"], shared["min_trials"])
+        lora, train_cfg, run = split_params(params)
+        trial_dir = os.path.join(shared["out_dir"], f"trial-{trial:03d}")
+        trainer, metrics = train(tok, ds_tr, ds_va, trial_dir, shared["base"], lora, train_cfg,
+                                 callbacks=[pruner] if shared["prune"] else None,
+                                 save_strategy="no", disable_tqdm=True, **run)
+        if pruner.pruned_at is None:
+            evals = [h for h in trainer.state.log_history if "eval_loss" in h]
+            if not evals or evals[-1]["step"] != trainer.state.global_step:
+                pruner.record(trainer.state.epoch, trainer.evaluate()["eval_loss"])
+            if shared["save"]:
+                trainer.save_model(trial_dir)
+                tok.save_pretrained(trial_dir)
+        losses = [l for _, l in pruner.history]
+        row.update(metrics)
+        row.update({
+            "status": "pruned" if pruner.pruned_at is not None else "complete",
+            "epoch": trainer.state.epoch,
+            "eval_loss": losses[-1] if losses else None,
+            "best_eval_loss": min(losses) if losses else None,
+        })
+    except Exception as e:
+        traceback.print_exc()
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["wall_s"] = time.perf_counter() - started
+    return row
+
+
+TABLE_COLUMNS = ("trial", "status", "best_eval_loss", "eval_loss", "epoch", "tokens_per_s", "examples_per_s",
+                 "train_runtime_s", "threads")
+
+
+def write_table(rows, path):
+    """Results sorted best-first (completed trials by loss, then pruned, then failed) as CSV"""
+    rank = {"complete": 0, "pruned": 1, "failed": 2}
+    rows = sorted(rows, key=lambda r: (rank[r["status"]], r.get("best_eval_loss") or float("inf")))
+    param_names = sorted({k for r in rows for k in r["params"]})
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(TABLE_COLUMNS + tuple(param_names))
+        for r in rows:
+            w.writerow([r.get(c) for c in TABLE_COLUMNS] + [json.dumps(r["params"].get(k)) for k in param_names])
+    return rows
+
+
+def fmt(value, spec=".4g"):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Run a grid/random LoRA hyperparameter sweep in parallel processes")
+    p.add_argument("--spec", required=True, help="JSON sweep spec (see module docstring)")
+    p.add_argument("--out_dir", default="artifacts/sweep")
+    p.add_argument("--cores_per_trial", type=int, default=4)
+    p.add_argument("--parallel", type=int, default=0, help="trials at once (default: cores // cores_per_trial)")
+    p.add_argument("--no_prune", action="store_true", help="run every trial to completion")
+    p.add_argument("--prune_warmup_evals", type=int, default=1, help="evaluations before a trial can be pruned")
+    p.add_argument("--prune_min_trials", type=int, default=3, help="other trials needed to compare against")
+    p.add_argument("--save", action="store_true", help="save each completed trial's adapter")
+    args = p.parse_args()
+
+    with open(args.spec, encoding="utf-8") as f:
+        spec = json.load(f)
+    trials = trials_from_spec(spec)
+
+    cores = available_cores()
+    parallel = args.parallel or max(1, len(cores) // args.cores_per_trial)
+    parallel = max(1, min(parallel, len(trials)))
+    per_trial = max(1, len(cores) // parallel)
+
+    # Tokenise once; every trial memory-maps the same cache
+    tok = tokenizer_for(BASE)
+    ds_tr, ds_va = load_splits(tok, token_cache=True)
+
+    for sub in ("logs", "reports"):
+        os.makedirs(os.path.join(args.out_dir, sub), exist_ok=True)
+    for name in os.listdir(os.path.join(args.out_dir, "reports")):
+        os.remove(os.path.join(args.out_dir, "reports", name))  # loss curves from a previous sweep
+    shared = {
+        "base": BASE,
+        "train_cache": ds_tr.path,
+        "val_cache": ds_va.path,
+        "out_dir": args.out_dir,
+        "reports_dir": os.path.join(args.out_dir, "reports"),
+        "prune": not args.no_prune,
+        "warmup_evals": args.prune_warmup_evals,
+        "min_trials": args.prune_min_trials,
+        "save": args.save,
+    }
+
+    print(f"Sweep: {len(trials)} trials ({spec.get('method', 'grid')}), {parallel} at a time "
+          f"on {per_trial} cores each ({len(cores)} available)")
+
+    # spawn, not fork: the parent has already started torch's thread pool
+    ctx = mp.get_context("spawn")
+    slots = ctx.Queue()
+    for i in range(parallel):
+        # More trials than cores (--parallel) share them round-robin
+        slots.put(sorted({cores[(i * per_trial + j) % len(cores)] for j in range(per_trial)}))
+
+    def swept(row):
+        return json.dumps({k: row["params"].get(k) for k in spec.get("params", {})})
+
+    rows = []
+    started = time.perf_counter()
+    with open(os.path.join(args.out_dir, "results.jsonl"), "w", encoding="utf-8") as out, \
+            ProcessPoolExecutor(parallel, mp_context=ctx, initializer=_init_worker, initargs=(slots,)) as pool:
+        futures = {pool.submit(run_trial, i, params, shared): i for i, params in enumerate(trials)}
+        for fut in as_completed(futures):
+            row = fut.result()
+            rows.append(row)
+            out.write(json.dumps(row) + "\n")
+            out.flush()
+            print(f"[{len(rows)}/{len(trials)}] trial {row['trial']} {row['status']}: "
+                  f"best eval loss {fmt(row.get('best_eval_loss'))}, "
+                  f"{fmt(row.get('tokens_per_s'), ',.0f')} tokens/s, {swept(row)}"
+                  + (f" ({row['error']})" if "error" in row else ""))
+    wall = time.perf_counter() - started
+
+    rows = write_table(rows, os.path.join(args.out_dir, "results.csv"))
+    print("\n" + "="*60)
+    print(f"SWEEP RESULTS ({wall:.0f}s wall, {sum(r.get('train_runtime_s') or 0 for r in rows):.0f}s of training)")
+    print("="*60)
+    print(f"{'trial':>5} {'status':<9} {'best loss':>9} {'tokens/s':>9}  params")
+    for r in rows:
+        print(f"{r['trial']:>5} {r['status']:<9} {fmt(r.get('best_eval_loss')):>9} "
+              f"{fmt(r.get('tokens_per_s'), ',.0f'):>9}  {swept(r)}")
+    print(f"\nResults: {os.path.join(args.out_dir, 'results.csv')}")
+
+
+if __name__ == "__main__":
+    main()
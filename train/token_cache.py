@@ -0,0 +1,113 @@
+import os, json, shutil, hashlib
+import numpy as np
+from torch.utils.data import Dataset
+from train.utils import PROMPT_TEMPLATE
+
+# Bump when the tokenisation/label layout changes so old caches are rebuilt
+CACHE_VERSION = 1
+
+def file_digest(path, chunk=1 << 20):
+    """sha256 of a file's bytes"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def tokenizer_digest(tok):
+    """Identity of a tokenizer: its name plus a hash of its full definition"""
+    h = hashlib.sha256(str(tok.name_or_path).encode())
+    if hasattr(tok, "backend_tokenizer"):
+        spec = json.loads(tok.backend_tokenizer.to_str())
+        # truncation/padding are runtime state that every tok(...) call rewrites
+        spec.pop("truncation", None)
+        spec.pop("padding", None)
+        h.update(json.dumps(spec, sort_keys=True).encode())
+    else:
+        h.update(json.dumps(tok.get_vocab(), sort_keys=True).encode())
+    return h.hexdigest()
+
+def fingerprint(data_path, tok, max_in, max_out):
+    """Cache key over the data, tokenizer, length limits and prompt template"""
+    parts = [file_digest(data_path), tokenizer_digest(tok), str(max_in), str(max_out),
+             PROMPT_TEMPLATE, str(CACHE_VERSION)]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:20]
+
+def build_token_cache(data_path, tok, max_in, max_out, out_dir, chunk=1000):
+    """Tokenise a JSONL of instruction/output pairs into flat int32 arrays.
+
+    Layout: tokens.bin (all input ids, int32), offsets.npy (n+1 int64) and
+    prompt_lens.npy (int32); labels are the ids with the prompt part set to
+    -100, exactly as format_pair_fn produces them.
+    """
+    tmp = out_dir + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    offsets, prompt_lens = [0], []
+
+    def flush(instructions, targets, out):
+        prompts = [PROMPT_TEMPLATE.format(instruction=x) for x in instructions]
+        enc_in = tok(prompts, truncation=True, max_length=max_in)["input_ids"]
+        enc_out = tok(targets, truncation=True, max_length=max_out)["input_ids"]
+        for a, b in zip(enc_in, enc_out):
+            np.asarray(a + b, dtype=np.int32).tofile(out)
+            offsets.append(offsets[-1] + len(a) + len(b))
+            prompt_lens.append(len(a))
+
+    with open(os.path.join(tmp, "tokens.bin"), "wb") as out:
+        instructions, targets = [], []
+        for line in open(data_path, "r", encoding="utf-8"):
+            if not line.strip():
+                continue
+            ex = json.loads(line)
+            instructions.append(ex["instruction"])
+            targets.append(ex["output"])
+            if len(instructions) >= chunk:
+                flush(instructions, targets, out)
+                instructions, targets = [], []
+        if instructions:
+            flush(instructions, targets, out)
+
+    np.save(os.path.join(tmp, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp, "prompt_lens.npy"), np.asarray(prompt_lens, dtype=np.int32))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"source": data_path, "examples": len(prompt_lens), "tokens": offsets[-1],
+                   "max_in": max_in, "max_out": max_out, "version": CACHE_VERSION}, f, indent=2)
+
+    # Publish atomically so a crashed build never looks like a valid cache
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp, out_dir)
+    return out_dir
+
+class TokenizedDataset(Dataset):
+    """Memory-mapped view of a token cache; items match format_pair_fn's output"""
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.prompt_lens = np.load(os.path.join(path, "prompt_lens.npy"), mmap_mode="r")
+        n_tokens = int(self.offsets[-1])
+        self.tokens = (np.memmap(os.path.join(path, "tokens.bin"), dtype=np.int32, mode="r", shape=(n_tokens,))
+                       if n_tokens else np.zeros(0, dtype=np.int32))
+        self.lengths = np.diff(self.offsets).tolist()
+
+    def __len__(self):
+        return len(self.prompt_lens)
+
+    def __getitem__(self, i):
+        ids = np.asarray(self.tokens[self.offsets[i]:self.offsets[i + 1]], dtype=np.int64)
+        labels = ids.copy()
+        labels[:int(self.prompt_lens[i])] = -100
+        return {"input_ids": ids, "attention_mask": np.ones_like(ids), "labels": labels}
+
+def load_or_build(data_path, tok, max_in, max_out, cache_root="data/cache/tokenized"):
+    """Memory-mapped dataset for data_path, tokenising only if no matching cache exists.
+
+    Returns (dataset, cache_dir, built) where built is False on a cache hit.
+    """
+    name = os.path.splitext(os.path.basename(data_path))[0]
+    cache_dir = os.path.join(cache_root, f"{name}-{fingerprint(data_path, tok, max_in, max_out)}")
+    built = not os.path.isfile(os.path.join(cache_dir, "meta.json"))
+    if built:
+        build_token_cache(data_path, tok, max_in, max_out, cache_dir)
+    return TokenizedDataset(cache_dir), cache_dir, built
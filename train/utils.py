@@ -1,6 +1,8 @@
-import os
+import os, random, bisect
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
 from datasets import load_dataset
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, Trainer
 
 def get_env(name, default=None):
     """Safely get environment variable with fallback"""
@@ -20,6 +22,9 @@ def load_jsonl(path):
     """Load JSONL file as Hugging Face dataset"""
     return load_dataset("json", data_files=path, split="train")
 
+# Instruction -> training prompt; the response is appended after it
+PROMPT_TEMPLATE = "{instruction}\n\n### Response:\n"
+
 def format_pair_fn(tok, max_in=1024, max_out=384):
     """Create function that formats instruction-output pairs for training"""
     def fn(x):
@@ -27,7 +32,7 @@ def format_pair_fn(tok, max_in=1024, max_out=384):
         target = x["output"]
         
         # Build the full prompt
-        prompt = f"{instruction}\n\n### Response:\n"
+        prompt = PROMPT_TEMPLATE.format(instruction=instruction)
         
         # Tokenize instruction and target separately
         enc_in = tok(prompt, truncation=True, max_length=max_in)
@@ -46,3 +51,161 @@ def format_pair_fn(tok, max_in=1024, max_out=384):
             "labels": labels
         }
     return fn
+
+class PaddingCollator:
+    """Pad a batch to its longest example, keeping the -100 prompt labels from format_pair_fn"""
+    def __init__(self, pad_token_id, pad_to_multiple_of=8):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features):
+        width = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch = {
+            "input_ids": torch.full((len(features), width), self.pad_token_id, dtype=torch.long),
+            "attention_mask": torch.zeros((len(features), width), dtype=torch.long),
+            "labels": torch.full((len(features), width), -100, dtype=torch.long),
+        }
+        for i, f in enumerate(features):
+            n = len(f["input_ids"])
+            batch["input_ids"][i, :n] = torch.as_tensor(f["input_ids"])
+            batch["attention_mask"][i, :n] = torch.as_tensor(f["attention_mask"])
+            batch["labels"][i, :n] = torch.as_tensor(f["labels"])
+        return batch
+
+class PackedDataset(Dataset):
+    """Formatted examples packed into blocks of at most block_size tokens.
+
+    Blocks are filled best-fit-decreasing. Each item keeps its examples'
+    -100 prompt labels, restarts position_ids at every example and carries
+    the segment lengths so PackedCollator can block cross-example attention.
+    """
+    def __init__(self, dataset, lengths, block_size):
+        self.dataset = dataset
+        self.block_size = block_size
+
+        self.blocks, free = [], []  # free: sorted (space left, block id)
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            n = min(lengths[i], block_size)
+            k = bisect.bisect_left(free, (n, -1))
+            if k < len(free):
+                space, b = free.pop(k)
+                self.blocks[b].append(i)
+            else:
+                b, space = len(self.blocks), block_size
+                self.blocks.append([i])
+            if space - n > 0:
+                bisect.insort(free, (space - n, b))
+        self.lengths = [sum(min(lengths[i], block_size) for i in blk) for blk in self.blocks]
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, idx):
+        input_ids, labels, position_ids, seq_lens = [], [], [], []
+        for i in self.blocks[idx]:
+            ex = self.dataset[i]
+            n = min(len(ex["input_ids"]), self.block_size)
+            input_ids += list(ex["input_ids"][:n])
+            labels += list(ex["labels"][:n])
+            position_ids += list(range(n))
+            seq_lens.append(n)
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "seq_lens": seq_lens,
+        }
+
+class PackedCollator:
+    """Pad packed blocks and build a block-diagonal causal mask so examples can't see each other"""
+    def __init__(self, pad_token_id, pad_to_multiple_of=8, dtype=torch.float32):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.dtype = dtype
+
+    def __call__(self, features):
+        width = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        B = len(features)
+        input_ids = torch.full((B, width), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((B, width), -100, dtype=torch.long)
+        position_ids = torch.zeros((B, width), dtype=torch.long)
+        # Additive 4D mask: 0 where attention is allowed, dtype min elsewhere
+        allowed = torch.zeros((B, 1, width, width), dtype=torch.bool)
+        for i, f in enumerate(features):
+            n = len(f["input_ids"])
+            input_ids[i, :n] = torch.as_tensor(f["input_ids"])
+            labels[i, :n] = torch.as_tensor(f["labels"])
+            position_ids[i, :n] = torch.as_tensor(f["position_ids"])
+            start = 0
+            for length in f["seq_lens"]:
+                allowed[i, 0, start:start + length, start:start + length] = True
+                start += length
+        allowed &= torch.ones((width, width), dtype=torch.bool).tril()
+        # Padding rows attend to themselves so no row is fully masked
+        allowed |= torch.eye(width, dtype=torch.bool)
+
+        mask = torch.zeros((B, 1, width, width), dtype=self.dtype)
+        mask.masked_fill_(~allowed, torch.finfo(self.dtype).min)
+        return {"input_ids": input_ids, "attention_mask": mask, "position_ids": position_ids, "labels": labels}
+
+class TokenBudgetBatchSampler(Sampler):
+    """Group examples of similar length into batches whose padded size fits a token budget.
+
+    Batches are formed once from length-sorted indices (ties shuffled), so
+    the number of steps per epoch is fixed; their order is reshuffled on
+    every pass.
+    """
+    def __init__(self, lengths, max_tokens, max_batch_size=64, seed=42):
+        self.seed = seed
+        self.epoch = 0
+
+        order = list(range(len(lengths)))
+        random.Random(seed).shuffle(order)
+        order.sort(key=lambda i: lengths[i])
+
+        self.batches, batch, longest = [], [], 0
+        for i in order:
+            longest_if_added = max(longest, lengths[i])
+            if batch and (longest_if_added * (len(batch) + 1) > max_tokens or len(batch) >= max_batch_size):
+                self.batches.append(batch)
+                batch, longest_if_added = [], lengths[i]
+            batch.append(i)
+            longest = longest_if_added
+        if batch:
+            self.batches.append(batch)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        order = list(range(len(self.batches)))
+        random.Random(self.seed + self.epoch).shuffle(order)
+        self.epoch += 1
+        for b in order:
+            yield self.batches[b]
+
+    def mean_batch_size(self):
+        return sum(len(b) for b in self.batches) / max(1, len(self.batches))
+
+class BatchSamplerTrainer(Trainer):
+    """Trainer that draws training batches from a custom batch sampler"""
+    def __init__(self, *args, train_batch_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = train_batch_sampler
+
+    def get_train_dataloader(self):
+        if self.train_batch_sampler is None:
+            return super().get_train_dataloader()
+        loader = DataLoader(
+            self.train_dataset,
+            batch_sampler=self.train_batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+        )
+        return self.accelerator.prepare(loader)